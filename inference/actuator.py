@@ -0,0 +1,184 @@
+# Module to run the motors in their own process
+
+'''
+sortPos() blocks for several seconds, so the motors are driven from a
+separate process that owns the GPIO. The vision side sends commands through
+a pipe and carries on; the motion process works through them in order and
+reports every completion back. Running in its own process (optionally with
+real-time priority) also keeps stepper timing away from the GIL and from
+inference load.
+
+    motion = MotionController()
+    motion.sort(2)        # Returns at once
+    motion.wait()         # Block until everything sent so far is done
+    motion.close()
+'''
+
+import multiprocessing
+import os
+import threading
+import time
+
+def set_realtime_priority():
+    # Needs root or CAP_SYS_NICE, silently skipped otherwise
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(10))
+        return True
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.nice(-10)
+    except OSError:
+        pass
+    return False
+
+def motion_loop(connection, realtime=True):
+    '''Body of the motion process: execute commands until told to stop.'''
+    if realtime:
+        set_realtime_priority()
+    import motor # GPIO and PWM are set up in this process only
+    motor.turnServo(90)
+    if motor.home_on_start == True:
+        motor.homeCarriage()
+    connection.send({'event': 'ready', 'pid': os.getpid(), 'carriage': motor.carriage_position})
+
+    while True:
+        try:
+            command = connection.recv()
+        except EOFError:
+            break # Parent went away
+        name = command['command']
+        if name == 'stop':
+            break
+        start_time = time.monotonic()
+        error = None
+        try:
+            if name == 'sort':
+                motor.sortPos(command['position'])
+            elif name == 'servo':
+                motor.turnServo(command['angle'])
+            elif name == 'stepper':
+                motor.turnStepper(command['distance'])
+            elif name == 'home':
+                motor.homeCarriage()
+            else:
+                error = f'Unknown command: {name}'
+        except Exception as exception:
+            error = repr(exception)
+        connection.send({
+            'event': 'done',
+            'seq': command['seq'],
+            'command': name,
+            'position': command.get('position'),
+            'carriage': motor.carriage_position,
+            'duration': time.monotonic() - start_time,
+            'error': error,
+        })
+
+class MotionController:
+    def __init__(self, realtime=True, on_report=None):
+        '''`on_report` is called with every report, e.g. metrics.observe_motion.'''
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=motion_loop, args=(child_connection, realtime),
+                                       name='motion', daemon=True)
+        self.process.start()
+        child_connection.close()
+
+        self.send_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.alive = True # Until the pipe to the motion process breaks
+        self.closing = False
+        self.ready = False
+        self.seq = 0
+        self.completed = 0
+        self.position = None # Last bin sorted to
+        self.carriage = None # Half steps from centre
+        self.last_report = None
+        self.on_report = on_report
+        self.listener = threading.Thread(target=self.listen, daemon=True)
+        self.listener.start()
+
+    def listen(self):
+        # Collect reports from the motion process
+        while True:
+            try:
+                report = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            with self.condition:
+                if 'carriage' in report:
+                    self.carriage = report['carriage']
+                if report['event'] == 'ready':
+                    self.ready = True
+                elif report['event'] == 'done':
+                    self.completed = report['seq']
+                    self.last_report = report
+                    if report['command'] == 'sort' and report['error'] is None:
+                        self.position = report['position']
+                    if report['error'] is not None:
+                        print(f"\nMotion error in {report['command']}: {report['error']}")
+                self.condition.notify_all()
+            if self.on_report is not None:
+                self.on_report(report)
+        with self.condition:
+            self.ready = False
+            self.alive = False
+            self.condition.notify_all()
+        if not self.closing:
+            print("\nMotion process stopped, not sorting any more")
+
+    def send(self, command, **arguments):
+        '''
+        Queue a command and return its sequence number, without waiting.
+        Returns None once the motion process is gone, so a motor failure
+        never stops the vision side.
+        '''
+        with self.send_lock:
+            if not self.alive:
+                return None
+            with self.condition:
+                self.seq += 1
+                seq = self.seq
+            try:
+                self.connection.send(dict(arguments, command=command, seq=seq))
+            except (OSError, EOFError) as error:
+                with self.condition:
+                    self.alive = False
+                    self.seq -= 1
+                    self.condition.notify_all()
+                print(f"\nMotion process gone, not sorting any more: {error}")
+                return None
+        return seq
+
+    def sort(self, position):
+        return self.send('sort', position=position)
+
+    def servo(self, angle):
+        return self.send('servo', angle=angle)
+
+    def stepper(self, distance):
+        return self.send('stepper', distance=distance)
+
+    def home(self):
+        return self.send('home')
+
+    def busy(self):
+        with self.condition:
+            return self.completed < self.seq
+
+    def wait(self, seq=None, timeout=None):
+        '''Wait until command `seq` (default: everything sent) is done.'''
+        with self.condition:
+            seq = self.seq if seq is None else seq
+            return self.condition.wait_for(
+                lambda: self.completed >= seq or not self.process.is_alive(), timeout)
+
+    def close(self, timeout=30):
+        self.closing = True
+        if self.process.is_alive():
+            self.send('stop')
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.connection.close()
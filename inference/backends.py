@@ -0,0 +1,206 @@
+# Module to run the model on an Edge TPU, the CPU or a fake interpreter
+
+'''
+All backends share the same API, so the rest of inference/ does not care
+where the model runs:
+
+    backend.input_size()                 (width, height)
+    backend.num_classes()
+    backend.set_input(image)             uint8 RGB image of input_size()
+    backend.invoke()
+    backend.get_scores()                 Dequantised score vector
+    backend.get_classes(top_k, threshold) Like pycoral.adapters.classify.get_classes
+    backend.set_batch_size(n)            Batch size in effect (1 unless on the CPU)
+    backend.infer_batch(images)          (N, classes) scores for an (N, H, W, 3) batch
+    backend.warm_up(runs)                Pay the slow first inference up front
+
+Backends:
+    edgetpu  pycoral make_interpreter() with the *_edgetpu.tflite model
+    cpu      TFLite interpreter with the plain .tflite model on `num_threads`
+             threads (XNNPACK is applied by the default op resolver)
+    fake     No model, returns "no match" scores, for tests and benchmarks
+'''
+
+import collections
+import os
+import numpy as np
+
+KINDS = ('auto', 'edgetpu', 'cpu', 'fake')
+
+# Same shape as pycoral.adapters.classify.Class
+Class = collections.namedtuple('Class', ['id', 'score'])
+
+def input_tensor(interpreter):
+    # Writable view of the input tensor, do not hold on to it across invoke()
+    return interpreter.tensor(interpreter.get_input_details()[0]['index'])()[0]
+
+class Backend:
+    name = 'backend'
+
+    def __init__(self, interpreter, device=''):
+        self.interpreter = interpreter
+        self.device = device
+        self.interpreter.allocate_tensors()
+        self.output_details = self.interpreter.get_output_details()[0]
+        scale, zero_point = self.output_details['quantization']
+        self.scale = scale
+        self.zero_point = zero_point
+
+    def describe(self):
+        return f'{self.name}:{self.device}' if self.device else self.name
+
+    def input_size(self):
+        _, height, width, _ = self.interpreter.get_input_details()[0]['shape']
+        return width, height
+
+    def num_classes(self):
+        return int(self.output_details['shape'][-1])
+
+    def set_input(self, image):
+        np.copyto(input_tensor(self.interpreter), image)
+
+    def invoke(self):
+        self.interpreter.invoke()
+
+    def dequantize(self, output):
+        if self.scale:
+            return (output.astype(np.float32) - self.zero_point) * self.scale
+        return output.astype(np.float32)
+
+    def get_scores(self):
+        return self.dequantize(self.interpreter.get_tensor(self.output_details['index'])[0])
+
+    def get_classes(self, top_k=1, threshold=0.0):
+        return top_classes(self.get_scores(), top_k, threshold)
+
+    def classify(self, image, top_k=1, threshold=0.0):
+        self.set_input(image)
+        self.invoke()
+        return self.get_classes(top_k, threshold)
+
+    def warm_up(self, runs=1):
+        # The first invoke is slow (e.g. model upload to the Edge TPU), pay it at startup
+        width, height = self.input_size()
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        for _ in range(runs):
+            self.set_input(image)
+            self.invoke()
+
+    def set_batch_size(self, batch_size):
+        # Edge TPU models are compiled for a batch of one
+        return 1
+
+    def infer_batch(self, images):
+        scores = np.empty((len(images), self.num_classes()), dtype=np.float32)
+        for index, image in enumerate(images):
+            self.set_input(image)
+            self.invoke()
+            scores[index] = self.get_scores()
+        return scores
+
+class EdgeTPUBackend(Backend):
+    name = 'edgetpu'
+
+    def __init__(self, model, device=None):
+        from pycoral.utils.edgetpu import make_interpreter
+        super().__init__(make_interpreter(model, device=device), device or '')
+
+class CPUBackend(Backend):
+    name = 'cpu'
+
+    def __init__(self, model, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf # x86 dev boxes with full TensorFlow
+            Interpreter = tf.lite.Interpreter
+        num_threads = num_threads or os.cpu_count() or 1
+        super().__init__(Interpreter(model_path=model, num_threads=num_threads),
+                         f'{num_threads} threads')
+        self.batch_size = 1
+
+    def set_batch_size(self, batch_size):
+        details = self.interpreter.get_input_details()[0]
+        self.interpreter.resize_tensor_input(details['index'], [batch_size, *details['shape'][1:]])
+        self.interpreter.allocate_tensors()
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.batch_size = batch_size
+        return batch_size
+
+    def infer_batch(self, images):
+        if self.batch_size == 1:
+            return super().infer_batch(images)
+        count = len(images)
+        index = self.interpreter.get_input_details()[0]['index']
+        self.interpreter.tensor(index)()[:count] = images
+        self.invoke()
+        output = self.interpreter.get_tensor(self.output_details['index'])
+        return self.dequantize(output[:count])
+
+class FakeBackend(Backend):
+    name = 'fake'
+
+    def __init__(self, size=(224, 224), num_classes=6):
+        # No interpreter, scores are all zero ("no match")
+        self.device = ''
+        self.size = tuple(size)
+        self.classes = num_classes
+        self.scores = np.zeros(num_classes, dtype=np.float32)
+
+    def input_size(self):
+        return self.size
+
+    def num_classes(self):
+        return self.classes
+
+    def set_input(self, image):
+        pass
+
+    def invoke(self):
+        pass
+
+    def get_scores(self):
+        return self.scores.copy()
+
+    def infer_batch(self, images):
+        return np.zeros((len(images), self.classes), dtype=np.float32)
+
+def top_classes(scores, top_k=1, threshold=0.0):
+    '''Vectorised equivalent of pycoral get_classes() on a score vector.'''
+    top_k = min(top_k, len(scores))
+    candidates = np.argpartition(scores, -top_k)[-top_k:]
+    candidates = candidates[np.argsort(scores[candidates])[::-1]]
+    return [Class(int(i), float(scores[i])) for i in candidates if scores[i] >= threshold]
+
+def edge_tpu_devices():
+    '''Device strings for make_interpreter(), e.g. ['usb:0', 'usb:1', 'pci:0'].'''
+    try:
+        from pycoral.utils.edgetpu import list_edge_tpus
+    except ImportError:
+        return []
+    counts = {}
+    devices = []
+    for tpu in list_edge_tpus():
+        index = counts.get(tpu['type'], 0)
+        counts[tpu['type']] = index + 1
+        devices.append(f"{tpu['type']}:{index}")
+    return devices
+
+def make_backend(kind='auto', edgetpu_model=None, cpu_model=None, device=None,
+                 num_threads=None, num_classes=6):
+    '''
+    Create a backend by kind. 'auto' uses an Edge TPU when one is present
+    and falls back to the CPU model when there is none or it fails to load.
+    '''
+    if kind not in KINDS:
+        raise ValueError(f'Unknown backend: {kind}')
+    if kind == 'fake':
+        return FakeBackend(num_classes=num_classes)
+    if kind == 'edgetpu':
+        return EdgeTPUBackend(edgetpu_model, device)
+    if kind == 'auto' and edgetpu_model and (device or edge_tpu_devices()):
+        try:
+            return EdgeTPUBackend(edgetpu_model, device)
+        except (ImportError, RuntimeError, ValueError) as error:
+            print(f'Edge TPU unavailable ({error}), falling back to CPU')
+    return CPUBackend(cpu_model, num_threads)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# Classify a directory tree of archived images offline
+
+'''
+Images are decoded and preprocessed by a thread pool straight into one of
+two batch buffers, so the next batch is decoded while the current one is on
+the interpreter. Results are streamed to CSV or JSONL as they come. When the
+images sit in one folder per class (like train/images-resized), the folder
+names are taken as the true labels and a confusion matrix is printed.
+
+    python3 batch_classify.py ../train/images-resized --backend cpu --output results.csv
+'''
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import threading
+import time
+import cv2
+import numpy as np
+from backends import KINDS, make_backend
+from benchmark import list_images
+from preprocess import Preprocessor
+from pycoral.utils.dataset import read_label_file
+
+# Folder names that differ from the label file
+DEFAULT_ALIASES = {'trash': 'rubbish'}
+
+class ResultWriter:
+    FIELDS = ['path', 'true_label', 'label', 'id', 'score']
+
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.jsonl = path.endswith(('.jsonl', '.json'))
+        self.csv = None
+        if not self.jsonl:
+            self.csv = csv.DictWriter(self.file, fieldnames=self.FIELDS)
+            self.csv.writeheader()
+
+    def write(self, row):
+        if self.jsonl:
+            self.file.write(json.dumps(row) + '\n')
+        else:
+            self.csv.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+def folder_labels(files, root, labels, aliases):
+    '''True label id per file from its top-level folder, or -1 when unknown.'''
+    ids = {name: label_id for label_id, name in labels.items()}
+    true_ids = np.full(len(files), -1, dtype=np.int64)
+    for index, path in enumerate(files):
+        folder = os.path.relpath(path, root).split(os.sep)[0]
+        if folder == os.path.basename(path):
+            continue # Image directly under the root, no folder label
+        true_ids[index] = ids.get(aliases.get(folder, folder), -1)
+    return true_ids
+
+def print_confusion(matrix, labels):
+    names = [labels.get(i, str(i)) for i in range(len(matrix))]
+    width = max(len(name) for name in names) + 1
+    print('\n===== Confusion matrix (rows: true, columns: predicted) =====')
+    print(' ' * width + ''.join(f'{name[:8]:>9}' for name in names))
+    for name, row in zip(names, matrix):
+        print(f'{name:<{width}}' + ''.join(f'{count:>9}' for count in row))
+    total = matrix.sum()
+    if total:
+        print(f'Accuracy: {np.trace(matrix) / total * 100:.2f}% of {total} labelled images')
+
+def classify_files(files, backend, batch_size=32, workers=None, on_batch=None):
+    '''
+    Classify image files in batches. Calls on_batch(indices, scores) with
+    the file indices that decoded and their (N, classes) scores.
+    '''
+    batch_size = backend.set_batch_size(batch_size) if batch_size > 1 else 1
+    width, height = backend.input_size()
+    buffers = [np.empty((batch_size, height, width, 3), dtype=np.uint8) for _ in range(2)]
+    local = threading.local()
+
+    def decode_into(path, dst):
+        # Each worker thread keeps its own preprocessor
+        if not hasattr(local, 'preprocessor'):
+            local.preprocessor = Preprocessor((width, height), buffers=1)
+        frame = cv2.imread(path)
+        if frame is None:
+            return False # Skip files that couldn't be opened as images
+        local.preprocessor(frame, dst)
+        return True
+
+    def submit(executor, batch_index):
+        start = batch_index * batch_size
+        chunk = files[start:start + batch_size]
+        buffer = buffers[batch_index % 2]
+        return [executor.submit(decode_into, path, buffer[slot])
+                for slot, path in enumerate(chunk)]
+
+    num_batches = (len(files) + batch_size - 1) // batch_size
+    decode_time = 0.0
+    inference_time = 0.0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = submit(executor, 0) if num_batches else []
+        for batch_index in range(num_batches):
+            start_time = time.perf_counter()
+            decoded = np.array([future.result() for future in pending], dtype=bool)
+            decode_time += time.perf_counter() - start_time
+            if batch_index + 1 < num_batches:
+                pending = submit(executor, batch_index + 1) # Decode ahead
+
+            start_time = time.perf_counter()
+            batch = buffers[batch_index % 2][:len(decoded)]
+            scores = backend.infer_batch(batch)[decoded]
+            inference_time += time.perf_counter() - start_time
+
+            indices = batch_index * batch_size + np.flatnonzero(decoded)
+            if on_batch is not None:
+                on_batch(indices, scores)
+    return decode_time, inference_time
+
+def main():
+    default_model_dir = '../train'
+    parser = argparse.ArgumentParser(description='Batched offline classification of an image directory')
+    parser.add_argument('directory', help='image directory, e.g. ../train/images-resized')
+    parser.add_argument('--backend', choices=KINDS, default='auto')
+    parser.add_argument('--model', default=os.path.join(default_model_dir, 'mobilenet_v2_recycle_edgetpu.tflite'),
+                        help='Edge TPU .tflite model path')
+    parser.add_argument('--cpu-model', default=os.path.join(default_model_dir, 'mobilenet_v2_recycle.tflite'),
+                        help='CPU .tflite model path')
+    parser.add_argument('--labels', default=os.path.join(default_model_dir, 'recycle.txt'),
+                        help='label file path')
+    parser.add_argument('--threads', type=int, default=None, help='CPU interpreter threads')
+    parser.add_argument('--workers', type=int, default=None, help='image decoding threads')
+    parser.add_argument('--batch-size', type=int, default=32, help='images per interpreter call (CPU)')
+    parser.add_argument('--output', help='stream results to this .csv or .jsonl file')
+    parser.add_argument('--alias', action='append', default=[], metavar='FOLDER=LABEL',
+                        help='map a folder name to a label name (default: trash=rubbish)')
+    args = parser.parse_args()
+
+    labels = read_label_file(args.labels)
+    aliases = dict(DEFAULT_ALIASES)
+    aliases.update(alias.split('=', 1) for alias in args.alias)
+    backend = make_backend(args.backend, args.model, args.cpu_model,
+                           num_threads=args.threads, num_classes=len(labels))
+    files = list_images(args.directory)
+    true_ids = folder_labels(files, args.directory, labels, aliases)
+    num_classes = len(labels)
+    confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+    writer = ResultWriter(args.output) if args.output else None
+    print(f'===== {len(files)} images on {backend.describe()} =====')
+
+    done = 0
+    def on_batch(indices, scores):
+        nonlocal done
+        predicted = scores.argmax(axis=1)
+        predicted_scores = scores[np.arange(len(indices)), predicted]
+        # Confusion matrix, vectorised over the batch
+        truth = true_ids[indices]
+        known = (truth >= 0) & (predicted < num_classes)
+        np.add.at(confusion, (truth[known], predicted[known]), 1)
+        if writer is not None:
+            for index, class_id, score in zip(indices, predicted, predicted_scores):
+                true_id = true_ids[index]
+                writer.write({
+                    'path': files[index],
+                    'true_label': labels.get(int(true_id), '') if true_id >= 0 else '',
+                    'label': labels.get(int(class_id), str(class_id)),
+                    'id': int(class_id),
+                    'score': round(float(score), 5),
+                })
+        done += len(indices)
+        print(f'\r{done}/{len(files)} images', end='', flush=True)
+
+    start_time = time.perf_counter()
+    try:
+        decode_time, inference_time = classify_files(files, backend, args.batch_size,
+                                                     args.workers, on_batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    elapsed = time.perf_counter() - start_time
+
+    print(f'\n{done} images in {elapsed:.2f} s, {done / max(elapsed, 1e-6):.1f} images/s '
+          f'(waiting on decode {decode_time:.2f} s, inference {inference_time:.2f} s)')
+    if confusion.any():
+        print_confusion(confusion, labels)
+
+if __name__ == '__main__':
+    main()
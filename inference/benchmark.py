@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Replay a video or an image directory through the classify pipeline, headless
+
+'''
+The replay runs through the same Lane as classify.py (change gate and
+preprocessing, inference, decision, per-class thresholds, detection mode),
+without an actuator, so no camera, GPIO or motors are needed. Its queues
+block instead of dropping, so every frame is processed. FPS and
+p50/p95/p99 latency of every step are printed as JSON: capture (reading
+and decoding the source), preprocess, inference (including postprocess),
+postprocess (reading and decoding the outputs) and decision.
+
+End-to-end latency is left out: with blocking queues the frames mostly
+wait for the stage in front of them, so it measures queue depth rather
+than processing time. The live lanes report it as a metric.
+
+    python3 benchmark.py ../train/images-resized --backend cpu
+    python3 benchmark.py clip.mp4 --backend edgetpu --output bench.json
+'''
+
+import argparse
+import json
+import os
+import time
+import cv2
+import numpy as np
+import classify
+from backends import KINDS, make_backend
+from decision import MODES
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+STAGES = ('capture', 'preprocess', 'inference', 'postprocess', 'decision')
+
+class ReplaySource:
+    '''cv2.VideoCapture-like reader over a video file or an image directory.'''
+    def __init__(self, path, repeat=1, limit=None):
+        self.path = path
+        self.repeat = max(1, repeat)
+        self.limit = limit
+        self.count = 0
+        if os.path.isdir(path):
+            self.files = list_images(path)
+            if not self.files:
+                raise ValueError(f'No images in {path}')
+            self.video = None
+            self.index = 0
+        else:
+            self.files = None
+            self.video = cv2.VideoCapture(path)
+            if not self.video.isOpened():
+                raise ValueError(f'Cannot open video {path}')
+        self.round = 0
+
+    def read(self):
+        if self.limit is not None and self.count >= self.limit:
+            return False, None
+        while self.round < self.repeat:
+            if self.files is not None:
+                if self.index < len(self.files):
+                    frame = cv2.imread(self.files[self.index])
+                    self.index += 1
+                    if frame is None:
+                        continue # Skip files that couldn't be opened as images
+                    self.count += 1
+                    return True, frame
+                self.index = 0
+            else:
+                working_result, frame = self.video.read()
+                if working_result:
+                    self.count += 1
+                    return True, frame
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.round += 1
+        return False, None
+
+    def isOpened(self):
+        return self.round < self.repeat
+
+    def release(self):
+        if self.video is not None:
+            self.video.release()
+
+def list_images(directory):
+    files = []
+    for subdir, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                files.append(os.path.join(subdir, name))
+    return files
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    values = np.asarray(samples) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        'count': len(samples),
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'max_ms': float(values.max()),
+    }
+
+def run_benchmark(source, backend, labels, settings):
+    '''
+    Replay `source` through a real Lane built by classify.make_lanes() from
+    `settings`, with blocking queues and no actuator, and return the report
+    dictionary.
+    '''
+    settings = dict(settings, camera_indices=[0])
+    lane = classify.make_lanes(settings, [backend], labels, sources=[source],
+                               queue_policy='block', keep_samples=True)[0]
+
+    start_time = time.perf_counter()
+    lane.start()
+    try:
+        lane.join()
+    finally:
+        lane.stop()
+    elapsed = time.perf_counter() - start_time
+
+    frames = lane.camera.captured
+    timings = lane.timings()
+    return {
+        'source': source.path,
+        'backend': backend.describe(),
+        'mode': settings['mode'],
+        'frames': frames,
+        'inferred': timings['inference']['count'],
+        'decisions': lane.decisions,
+        'elapsed_s': elapsed,
+        'fps': frames / elapsed if elapsed else 0.0,
+        'stages': {name: percentiles(lane.samples(name)) for name in STAGES},
+    }
+
+def main():
+    # Defaults follow classify.py, so the replay runs what the rig runs
+    defaults = classify.settings
+    parser = argparse.ArgumentParser(description='Headless replay benchmark of the classify pipeline')
+    parser.add_argument('source', help='video file or image directory, e.g. ../train/images-resized')
+    parser.add_argument('--backend', choices=KINDS, default='auto')
+    parser.add_argument('--mode', choices=('classify', 'detect'), default=defaults['mode'])
+    parser.add_argument('--model', help='Edge TPU .tflite model path (default: as in classify.py)')
+    parser.add_argument('--cpu-model', help='CPU .tflite model path (default: as in classify.py)')
+    parser.add_argument('--labels', default=os.path.join(defaults['model_dir'], defaults['model_labels']),
+                        help='label file path')
+    parser.add_argument('--thresholds', default=os.path.join(defaults['model_dir'], defaults['class_thresholds_file']),
+                        help='per-class thresholds file from calibrate.py, used when present')
+    parser.add_argument('--anchors', help='anchors .npy for detection models without post-processing')
+    parser.add_argument('--threads', type=int, default=None, help='CPU interpreter threads')
+    parser.add_argument('--threshold', type=float, default=defaults['inference_threshold']/100,
+                        help='classifier score threshold')
+    parser.add_argument('--decision', choices=MODES, default=defaults['decision_mode'])
+    parser.add_argument('--window', type=int, default=defaults['decision_window'], help='decision window, in frames')
+    parser.add_argument('--no-gate', action='store_true', help='infer every frame')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the source this many times')
+    parser.add_argument('--limit', type=int, default=None, help='stop after this many frames')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    edgetpu_model, cpu_model = classify.model_files(dict(defaults, mode=args.mode))
+    # Paths are given in full, so model_dir is emptied
+    settings = dict(defaults, model_dir='', mode=args.mode, backend=args.backend,
+                    model_labels=args.labels, class_thresholds_file=args.thresholds,
+                    detection_anchors_file=args.anchors,
+                    inference_threshold=args.threshold*100, decision_mode=args.decision,
+                    decision_window=args.window, idle_fps=0,
+                    change_threshold=-1 if args.no_gate else defaults['change_threshold'])
+    labels = classify.load_labels(settings)
+    backend = make_backend(args.backend, args.model or edgetpu_model, args.cpu_model or cpu_model,
+                           num_threads=args.threads, num_classes=len(labels))
+    source = ReplaySource(args.source, repeat=args.repeat, limit=args.limit)
+    try:
+        report = run_benchmark(source, backend, labels, settings)
+    finally:
+        source.release()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Pick a threshold per class from a labelled image set
+
+'''
+Runs the model over images sorted in one folder per class (like
+train/images-resized, better a held-out set) and, for every class, picks the
+lowest threshold at which the frames predicted as that class are still
+right at least `--precision` of the time. Classes the model is reliably
+right about then get accepted at lower scores, and fewer frames end up as
+"no match". The thresholds file is read by classify.py from model_dir.
+
+    python3 calibrate.py ../train/images-resized --precision 0.95 --backend cpu
+'''
+
+import argparse
+import json
+import os
+import numpy as np
+from backends import KINDS, make_backend
+from batch_classify import DEFAULT_ALIASES, classify_files, folder_labels
+from benchmark import list_images
+from decision import NONE, apply_thresholds, threshold_array
+from pycoral.utils.dataset import read_label_file
+
+def calibrate_class(top_scores, correct, precision, min_samples=10):
+    '''
+    Lowest threshold over `top_scores` (of the frames predicted as one
+    class) keeping the precision at least `precision`, with its precision
+    and number of accepted frames. None when no threshold qualifies.
+    '''
+    order = np.argsort(top_scores)[::-1]
+    scores = top_scores[order]
+    hits = np.cumsum(correct[order])
+    accepted = np.arange(1, len(scores) + 1)
+    precisions = hits / accepted
+    # Only cut between different scores, equal scores are accepted together
+    cuts = np.r_[scores[:-1] != scores[1:], True] if len(scores) else np.zeros(0, dtype=bool)
+    valid = np.flatnonzero(cuts & (precisions >= precision) & (accepted >= min_samples))
+    if len(valid) == 0:
+        return None
+    index = valid[-1]
+    return float(scores[index]), float(precisions[index]), int(accepted[index])
+
+def calibrate(scores, true_ids, num_labels, precision, default, min_samples=10):
+    predicted = scores.argmax(axis=1)
+    top_scores = scores[np.arange(len(scores)), predicted]
+    results = {}
+    for class_id in range(num_labels):
+        mask = predicted == class_id
+        result = calibrate_class(top_scores[mask], true_ids[mask] == class_id, precision, min_samples)
+        if result is None:
+            results[class_id] = {'threshold': default, 'calibrated': False}
+            continue
+        threshold, class_precision, accepted = result
+        found = mask & (true_ids == class_id) & (top_scores >= threshold)
+        results[class_id] = {
+            'threshold': threshold,
+            'calibrated': True,
+            'precision': class_precision,
+            'recall': np.count_nonzero(found) / max(np.count_nonzero(true_ids == class_id), 1),
+        }
+    return results
+
+def no_match_rate(scores, thresholds):
+    class_ids, _ = apply_thresholds(scores, thresholds)
+    return float(np.mean(class_ids == NONE))
+
+def main():
+    default_model_dir = '../train'
+    parser = argparse.ArgumentParser(description='Calibrate per-class thresholds on a labelled image set')
+    parser.add_argument('directory', help='image directory with one folder per class')
+    parser.add_argument('--precision', type=float, default=0.95, help='target precision per class')
+    parser.add_argument('--default', type=float, default=0.8,
+                        help='threshold for classes without enough samples')
+    parser.add_argument('--min-samples', type=int, default=10,
+                        help='frames a threshold must accept to be trusted')
+    parser.add_argument('--backend', choices=KINDS, default='auto')
+    parser.add_argument('--model', default=os.path.join(default_model_dir, 'mobilenet_v2_recycle_edgetpu.tflite'),
+                        help='Edge TPU .tflite model path')
+    parser.add_argument('--cpu-model', default=os.path.join(default_model_dir, 'mobilenet_v2_recycle.tflite'),
+                        help='CPU .tflite model path')
+    parser.add_argument('--labels', default=os.path.join(default_model_dir, 'recycle.txt'),
+                        help='label file path')
+    parser.add_argument('--threads', type=int, default=None, help='CPU interpreter threads')
+    parser.add_argument('--batch-size', type=int, default=32, help='images per interpreter call (CPU)')
+    parser.add_argument('--output', default=os.path.join(default_model_dir, 'recycle_thresholds.json'),
+                        help='thresholds file to write')
+    args = parser.parse_args()
+
+    labels = read_label_file(args.labels)
+    backend = make_backend(args.backend, args.model, args.cpu_model,
+                           num_threads=args.threads, num_classes=len(labels))
+    files = list_images(args.directory)
+    true_ids = folder_labels(files, args.directory, labels, DEFAULT_ALIASES)
+    known = np.flatnonzero(true_ids >= 0)
+    files = [files[index] for index in known]
+    true_ids = true_ids[known]
+    print(f'===== {len(files)} labelled images on {backend.describe()} =====')
+
+    scores = np.empty((len(files), backend.num_classes()), dtype=np.float32)
+    def on_batch(indices, batch_scores):
+        scores[indices] = batch_scores
+    classify_files(files, backend, args.batch_size, on_batch=on_batch)
+
+    results = calibrate(scores, true_ids, len(labels), args.precision, args.default, args.min_samples)
+    for class_id, result in results.items():
+        if result['calibrated']:
+            print(f"{labels[class_id]}: {result['threshold'] * 100:.1f}% "
+                  f"(precision {result['precision'] * 100:.1f}%, recall {result['recall'] * 100:.1f}%)")
+        else:
+            print(f"{labels[class_id]}: {result['threshold'] * 100:.1f}% (default, not enough confident samples)")
+
+    single = threshold_array(scores.shape[1], args.default)
+    per_class = threshold_array(scores.shape[1], args.default,
+                                {class_id: result['threshold'] for class_id, result in results.items()})
+    print(f'No match: {no_match_rate(scores, single) * 100:.1f}% of images with one {args.default * 100:.0f}% '
+          f'threshold, {no_match_rate(scores, per_class) * 100:.1f}% with per-class thresholds')
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'backend': backend.describe(),
+            'target_precision': args.precision,
+            'images': len(files),
+            'thresholds': {labels[class_id]: round(result['threshold'], 4)
+                           for class_id, result in results.items()},
+        }, f, indent=2)
+    print(f'Wrote {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Module to grab camera frames on a background thread
+
+import threading
+import time
+
+class FrameGrabber:
+    '''
+    Wraps a cv2.VideoCapture-like source and keeps only the newest frame.
+
+    A capture thread reads continuously into a single "latest frame" slot,
+    so a slow consumer (inference, sorting) always gets the most recent
+    frame instead of working through stale driver buffers. Frames that are
+    overwritten before being read are counted in `dropped`.
+
+    With `block`, the capture thread instead waits until the previous frame
+    was read, so none are dropped (for replays, see benchmark.py). `stats`
+    gets the duration of every source.read(), e.g. a pipeline.StageStats.
+    '''
+    def __init__(self, source, block=False, stats=None):
+        self.source = source
+        self.block = block
+        self.stats = stats
+        self.condition = threading.Condition()
+        self.running = False
+        self.frame = None
+        self.timestamp = 0
+        self.seq = 0
+        self.last_seq = 0
+        self.captured = 0
+        self.dropped = 0
+        self.worker = None
+
+        # Ask the driver to hold as few buffers as possible (V4L2 only)
+        try:
+            import cv2
+            self.source.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        except (ImportError, AttributeError):
+            pass
+
+    def start(self):
+        self.running = True
+        self.worker = threading.Thread(target=self.capture_loop, daemon=True)
+        self.worker.start()
+        return self
+
+    def capture_loop(self):
+        while self.running:
+            if self.block:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.seq == self.last_seq or not self.running)
+                    if not self.running:
+                        break
+            start_time = time.perf_counter()
+            working_result, frame = self.source.read()
+            timestamp = time.monotonic()
+            if working_result and self.stats is not None:
+                self.stats.add(time.perf_counter() - start_time) # Driver wait and decode
+            with self.condition:
+                if not working_result:
+                    self.running = False
+                    self.condition.notify_all()
+                    break
+                if self.seq != self.last_seq:
+                    self.dropped += 1 # Previous frame was never consumed
+                self.frame = frame
+                self.timestamp = timestamp
+                self.seq += 1
+                self.captured += 1
+                self.condition.notify_all()
+
+    def read(self, timeout=None):
+        '''Wait for a frame newer than the last one read, like VideoCapture.read().'''
+        frame, _ = self.read_with_timestamp(timeout)
+        return frame is not None, frame
+
+    def read_with_timestamp(self, timeout=None):
+        '''(frame, time.monotonic() when it was read from the source), (None, 0) once stopped.'''
+        with self.condition:
+            if not self.condition.wait_for(
+                    lambda: self.seq != self.last_seq or not self.running, timeout):
+                return None, 0
+            if self.seq == self.last_seq:
+                return None, 0 # Stopped with nothing new
+            self.last_seq = self.seq
+            frame = self.frame
+            self.frame = None
+            self.condition.notify_all() # A blocking capture thread can read the next one
+            return frame, self.timestamp
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.worker is not None and self.worker is not threading.current_thread():
+            self.worker.join()
+
+    def release(self):
+        self.stop()
+        self.source.release()
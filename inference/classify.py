@@ -1,98 +1,223 @@
 #!/usr/bin/env python3
 enable_gpio = True
 
-import cv2
+# Heavy modules (cv2, NumPy, pycoral, TFLite) are imported inside the
+# functions that need them, so importing this file (e.g. from classifyd.py
+# or the spawned motion process) stays cheap.
+import functools
 import os
 import sys
-from motor import turnServo, turnStepper, sortPos
-from PIL import Image
-from pycoral.adapters.common import input_size
-from pycoral.adapters.classify import get_classes
-from pycoral.utils.dataset import read_label_file
-from pycoral.utils.edgetpu import make_interpreter
-from pycoral.utils.edgetpu import run_inference
-    
+import time
+
+# Define constants
+settings = {
+    'model_dir': '../train',
+    'model_file': 'mobilenet_v2_recycle_edgetpu.tflite',
+    'cpu_model_file': 'mobilenet_v2_recycle.tflite', # For lanes without an Edge TPU
+    'model_labels': 'recycle.txt',
+    'backend': 'auto', # 'auto', 'edgetpu', 'cpu' or 'fake', see backends.py
+    'mode': 'classify', # 'classify' (whole frame) or 'detect' (SSD model, several items, see detection.py)
+    'detection_model_file': 'model/ssd_mobilenet_v2_recycle_edgetpu.tflite',
+    'detection_cpu_model_file': 'model/ssd_mobilenet_v2_recycle.tflite',
+    'detection_anchors_file': None, # (N, 4) .npy in model_dir, only for SSD models without post-processing
+    'detection_threshold': 50, # Minimum box score, in %
+    'camera_indices': [0], # As in /dev/videoX, one sorting lane per camera
+    'actuated_lane': 0, # Lane driving the motors in motor.py, through the motion process
+    'inference_threshold': 80, # Threshold, in %
+    'class_thresholds_file': 'recycle_thresholds.json', # In model_dir, from calibrate.py, overrides the above per class
+    'decision_mode': 'ema', # 'ema', 'majority' or 'dwell'
+    'decision_window': 5, # Frames
+    'change_threshold': 6, # Mean grey level difference, 0-255
+    'idle_fps': 1, # Inference rate while the scene is static
+    'sort_bins': {'paper': 1, 'plastic': 2, 'metal': 3, 'rubbish': 4, 'glass': 4}, # Cardboard stays
+    'warm_up_runs': 1, # Inferences run at startup so the first frame isn't slow
+    'watch_model': True, # Swap in a retrained model without restarting, see reloader.py
+    'event_log_dir': 'events', # Binary decision log, see eventlog.py, None to disable
+    'metrics_port': 9108, # Prometheus text on http://127.0.0.1:<port>/metrics, None to disable
+}
+
+# Settings that need new interpreters when changed
+BACKEND_SETTINGS = ('model_dir', 'model_file', 'cpu_model_file', 'model_labels',
+                    'backend', 'camera_indices', 'warm_up_runs', 'mode',
+                    'detection_model_file', 'detection_cpu_model_file')
+
+# Settings only read when classify.py or classifyd.py starts
+STARTUP_SETTINGS = ('event_log_dir', 'metrics_port', 'watch_model')
+
+def load_labels(settings):
+    from pycoral.utils.dataset import read_label_file
+    return read_label_file(os.path.join(settings['model_dir'], settings['model_labels']))
+
+def model_files(settings):
+    '''(Edge TPU, CPU) model paths for the current mode.'''
+    prefix = 'detection_' if settings['mode'] == 'detect' else ''
+    return (os.path.join(settings['model_dir'], settings[f'{prefix}model_file']),
+            os.path.join(settings['model_dir'], settings[f'{prefix}cpu_model_file']))
+
+def make_backends(settings, labels):
+    '''One warmed-up backend per lane, on the device the scheduler picks.'''
+    from backends import edge_tpu_devices
+    from lanes import schedule_devices, make_lane_backend
+    backend = settings['backend']
+    tpus = edge_tpu_devices() if backend in ('auto', 'edgetpu') else []
+    assignments = schedule_devices(len(settings['camera_indices']), tpus)
+    edgetpu_model, cpu_model = model_files(settings)
+    backends = []
+    for assignment in assignments:
+        lane_backend = make_lane_backend(backend, assignment, edgetpu_model, cpu_model,
+                                         num_classes=len(labels))
+        lane_backend.warm_up(settings['warm_up_runs'])
+        backends.append(lane_backend)
+    return backends
+
+def load_class_thresholds(settings):
+    '''Per-class thresholds by label name, empty without a thresholds file.'''
+    if settings['class_thresholds_file'] is None:
+        return {}
+    path = os.path.join(settings['model_dir'], settings['class_thresholds_file'])
+    if not os.path.exists(path):
+        return {}
+    from decision import load_thresholds
+    return load_thresholds(path)
+
+def make_lanes(settings, backends, labels, motion=None, event_log=None, sources=None, **lane_options):
+    '''
+    One lane per camera in camera_indices, or per cv2.VideoCapture-like
+    object in `sources`. `lane_options` go to every Lane, e.g. queue_policy.
+    '''
+    import cv2
+    from lanes import Lane, DetectionLane
+    class_thresholds = load_class_thresholds(settings)
+    lane_class = Lane
+    detection_options = {}
+    if settings['mode'] == 'detect':
+        lane_class = DetectionLane
+        detection_options['detection_threshold'] = settings['detection_threshold']/100
+        if settings['detection_anchors_file'] is not None:
+            import numpy as np
+            detection_options['anchors'] = np.load(os.path.join(settings['model_dir'],
+                                                                settings['detection_anchors_file']))
+    if sources is None:
+        sources = [cv2.VideoCapture(camera_idx) for camera_idx in settings['camera_indices']]
+    lanes = []
+    for lane_idx, (source, lane_backend) in enumerate(zip(sources, backends)):
+        actuator = motion.sort if (motion is not None and lane_idx == settings['actuated_lane']) else None
+        lane_log = functools.partial(event_log.log_decision, lane_idx) if event_log is not None else None
+        lanes.append(lane_class(f'lane{lane_idx}', source, lane_backend, labels,
+                                actuator=actuator, sort_bins=settings['sort_bins'],
+                                threshold=settings['inference_threshold']/100,
+                                decision_mode=settings['decision_mode'],
+                                decision_window=settings['decision_window'],
+                                change_threshold=settings['change_threshold'],
+                                idle_fps=settings['idle_fps'],
+                                event_log=lane_log,
+                                class_thresholds=class_thresholds,
+                                **detection_options, **lane_options))
+    return lanes
+
+def print_summary(lanes):
+    for lane in lanes:
+        summary = lane.summary()
+        print(f"===== {summary['lane']} ({summary['device']}) =====")
+        print(f"{summary['capture_fps']:.1f} fps captured, {summary['inference_fps']:.1f} fps inferred, "
+              f"{summary['decisions']} decisions")
+        print(f"Captured {summary['captured']} frames, dropped {summary['dropped']}, "
+              f"skipped {summary['skipped']} static frames")
+        for name, timing in summary['timings'].items():
+            print(f"{name}: {timing['mean_ms']:.2f} ms avg, {timing['max_ms']:.2f} ms max, "
+                  f"{timing['count']} frames, {timing['dropped']} dropped")
+        try:
+            lane.join()
+        except Exception as error:
+            print(f'{lane.name} stopped with error: {error}')
+
+def start_metrics(settings):
+    if settings['metrics_port'] is None:
+        return None
+    import metrics
+    try:
+        server = metrics.serve(settings['metrics_port'])
+    except OSError as error:
+        print(f"Metrics disabled, cannot listen on port {settings['metrics_port']}: {error}")
+        return None
+    print(f"Metrics on http://127.0.0.1:{settings['metrics_port']}/metrics")
+    return server
+
+def make_event_log(settings):
+    if settings['event_log_dir'] is None:
+        return None
+    from eventlog import EventLog
+    return EventLog(settings['event_log_dir'])
+
+def make_motion(event_log=None):
+    # GPIO is owned by a separate motion process so sorting never stalls vision
+    from actuator import MotionController
+    from metrics import observe_motion
+    def on_report(report):
+        observe_motion(report)
+        if event_log is not None:
+            event_log.log_report(report)
+    return MotionController(on_report=on_report)
+
+def make_watcher(settings, get_lanes, input_size, swap=None):
+    '''Model watcher validating on, and by default swapping into, the lanes from get_lanes().'''
+    if not settings['watch_model']:
+        return None
+    from reloader import ModelWatcher, swap_lanes
+    if swap is None:
+        def swap(backends, labels, class_thresholds):
+            swap_lanes(get_lanes(), backends, labels, class_thresholds)
+    def frames():
+        return [lane.last_input.copy() for lane in get_lanes() if lane.last_input is not None]
+    return ModelWatcher(settings, swap, frames, input_size).start()
+
 def main():
-    # Define constants
-    model_dir = '../train'
-    model_file = 'mobilenet_v2_recycle_edgetpu.tflite'
-    model_labels = 'recycle.txt'
-    camera_idx = 0 # As in /dev/videoX
-    inference_threshold = 80 # Threshold, in %
-    
     # Initialise GPIO
+    event_log = make_event_log(settings)
+    motion = None
     if enable_gpio == True:
-        pass
-        
-    # Prepare model
-    print(f'===== {model_file} =====')
-    interpreter = make_interpreter(os.path.join(model_dir,model_file))
-    interpreter.allocate_tensors()
-    labels = read_label_file(os.path.join(model_dir,model_labels))
-    inference_size = input_size(interpreter)
-    turnServo(90)
-    
-    # Prepare camera
-    camera = cv2.VideoCapture(camera_idx)
+        motion = make_motion(event_log)
+    start_metrics(settings)
+
+    # Prepare models, one interpreter per lane on the scheduled device
+    print(f"===== {os.path.basename(model_files(settings)[0])} =====")
+    labels = load_labels(settings)
+    backends = make_backends(settings, labels)
+    lanes = make_lanes(settings, backends, labels, motion, event_log)
+    for lane, camera_idx in zip(lanes, settings['camera_indices']):
+        print(f'{lane.name}: /dev/video{camera_idx} on {lane.backend.describe()}')
+
+    # Main loop, each lane runs its own pipeline, this thread only displays
+    for lane in lanes:
+        lane.start()
+    watcher = make_watcher(settings, lambda: lanes, backends[0].input_size())
     previous_text_length = 0
-    previous_object_name = ""
-    
-    # Main loop
-    while camera.isOpened():
-        # Picture from camera
-        working_result, frame = camera.read()
-        if not working_result:
-            break
-        cv2_im = frame
-        cv2_im_rgb = cv2.cvtColor(cv2_im, cv2.COLOR_BGR2RGB)
-        cv2_im_rgb = cv2.resize(cv2_im_rgb, inference_size)
-        
-        # Run inference
-        run_inference(interpreter, cv2_im_rgb.tobytes())
-        results = get_classes(interpreter, 1, inference_threshold/100)
-        
-        # Process results
-        if len(results) == 0:
-            # No results
-            result = False
-            text = "--.--% - no match"
-            object_score = 0
-            object_name = "none"
-        elif len(results) > 0:
-            # Yes results
-            result = True
-            object_score = results[0].score
-            object_name = labels.get(results[0].id)
-            text = f"{object_score * 100:.2f}% - {object_name}"
-        
-        # Display result
-        if len(text) < previous_text_length:
-            sys.stdout.write('\x1b[2K')
-        print(f'\r{text}', end='', flush=True)
-        previous_text_length = len(text)
-        
-        # Action
-        if (enable_gpio == True) and (previous_object_name != object_name):
-            if result == True:
-                if object_name == "paper":
-                    sortPos(1)
-                if object_name == "plastic":
-                    sortPos(2)
-                if object_name == "metal":
-                    sortPos(3)
-                if object_name == "rubbish":
-                    sortPos(4)
-                if object_name == "cardboard":
-                    pass
-                else:
-                    sortPos(4)
-            previous_object_name = object_name
-            
-            
+    try:
+        while any(lane.is_alive() for lane in lanes):
+            time.sleep(0.2)
+            text = ' | '.join(f'{lane.name} {lane.fps()[1]:.1f} fps {lane.text}'
+                              for lane in lanes)
+            # Display result
+            if len(text) < previous_text_length:
+                sys.stdout.write('\x1b[2K')
+            print(f'\r{text}', end='', flush=True)
+            previous_text_length = len(text)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        for lane in lanes:
+            lane.stop()
+        if motion is not None:
+            motion.close()
+        if event_log is not None:
+            event_log.close()
+
     # Post-processing
-    camera.release()
-    cv2.destroyAllWindows()
-    
-    
+    print()
+    print_summary(lanes)
+
+
 if __name__ == '__main__':
     main()
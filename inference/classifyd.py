@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# Long-lived classifier daemon, controlled over a Unix socket
+
+'''
+Loading the model and the first Edge TPU inference take seconds, so the
+daemon loads and warms the interpreters once and keeps them. Lanes (cameras
+and pipelines) can then be stopped, reconfigured and restarted in well
+under a second without touching the interpreters.
+
+    python3 classifyd.py serve [--config settings.json]
+    python3 classifyd.py status
+    python3 classifyd.py reload inference_threshold=70 decision_mode=dwell
+    python3 classifyd.py stop | start | quit
+
+Requests and replies are one JSON object per line, e.g.
+{"command": "reload", "settings": {"idle_fps": 2}}. Changing a setting in
+classify.BACKEND_SETTINGS also rebuilds the interpreters; a reload that fails
+leaves the previous settings and lanes running. Settings in
+classify.STARTUP_SETTINGS need a restart of the daemon.
+'''
+
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import classify
+
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'classibin.sock')
+COMMANDS = ('status', 'start', 'stop', 'reload', 'quit')
+
+class ClassifierDaemon:
+    def __init__(self, settings):
+        self.settings = dict(settings)
+        self.lock = threading.Lock()
+        self.lanes = []
+        self.start_time = time.monotonic()
+        self.motion = None
+        self.event_log = classify.make_event_log(self.settings)
+        if classify.enable_gpio == True:
+            self.motion = classify.make_motion(self.event_log)
+        self.metrics_server = classify.start_metrics(self.settings)
+        self.labels, self.backends, self.load_time = self.load_backends(self.settings)
+        self.watcher = classify.make_watcher(self.settings, lambda: self.lanes,
+                                             self.backends[0].input_size(), swap=self.swap_model)
+
+    def load_backends(self, settings):
+        '''(labels, backends, load time) for `settings`, leaving the current ones in place.'''
+        start_time = time.perf_counter()
+        labels = classify.load_labels(settings)
+        backends = classify.make_backends(settings, labels)
+        load_time = time.perf_counter() - start_time
+        print(f"Loaded {os.path.basename(classify.model_files(settings)[0])} on "
+              f"{', '.join(b.describe() for b in backends)} in {load_time:.2f} s")
+        return labels, backends, load_time
+
+    def start(self, lanes=None):
+        if self.lanes:
+            return
+        if lanes is None:
+            lanes = classify.make_lanes(self.settings, self.backends, self.labels, self.motion,
+                                        self.event_log)
+        self.lanes = lanes
+        for lane in self.lanes:
+            lane.start()
+
+    def stop(self):
+        summaries = [lane_summary(lane) for lane in self.lanes]
+        for lane in self.lanes:
+            lane.stop()
+        for lane in self.lanes:
+            try:
+                lane.join()
+            except Exception as error:
+                print(f'{lane.name} stopped with error: {error}')
+        self.lanes = []
+        return summaries
+
+    def reload(self, changes):
+        unknown = set(changes) - set(self.settings)
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+        fixed = [key for key in classify.STARTUP_SETTINGS
+                 if key in changes and changes[key] != self.settings[key]]
+        if fixed:
+            raise ValueError(f"Restart the daemon to change {', '.join(sorted(fixed))}")
+        start_time = time.perf_counter()
+        was_running = bool(self.lanes)
+        self.stop()
+        new_settings = dict(self.settings, **changes)
+        rebuild = any(new_settings[key] != self.settings[key] for key in classify.BACKEND_SETTINGS)
+
+        # Build everything for the new settings before replacing anything, so
+        # a bad model, labels file or setting leaves the old lanes running
+        labels, backends, load_time = self.labels, self.backends, self.load_time
+        lanes = []
+        try:
+            if rebuild:
+                labels, backends, load_time = self.load_backends(new_settings)
+            if was_running:
+                lanes = classify.make_lanes(new_settings, backends, labels, self.motion,
+                                            self.event_log)
+        except Exception:
+            if was_running:
+                self.start()
+            raise
+        self.settings = new_settings
+        self.labels, self.backends, self.load_time = labels, backends, load_time
+        if self.watcher is not None:
+            self.watcher.settings = new_settings
+            if rebuild:
+                self.watcher.mark_loaded()
+        if was_running:
+            self.start(lanes)
+        return {'restart_s': time.perf_counter() - start_time, 'rebuilt_backends': rebuild}
+
+    def swap_model(self, backends, labels, class_thresholds):
+        # Called by the model watcher with validated, warmed-up backends
+        with self.lock:
+            if len(backends) != len(self.backends):
+                return # Lanes were reconfigured while the new model loaded
+            from reloader import swap_lanes
+            self.backends = backends
+            self.labels = labels
+            swap_lanes(self.lanes, backends, labels, class_thresholds)
+
+    def status(self):
+        return {
+            'running': bool(self.lanes),
+            'uptime_s': time.monotonic() - self.start_time,
+            'load_s': self.load_time,
+            'backends': [backend.describe() for backend in self.backends],
+            'settings': self.settings,
+            'lanes': [lane_summary(lane) for lane in self.lanes],
+            'motion_busy': self.motion.busy() if self.motion is not None else None,
+            'model_reloads': self.watcher.reloads if self.watcher is not None else None,
+        }
+
+    def handle(self, request):
+        command = request.get('command')
+        with self.lock:
+            if command == 'status':
+                return self.status()
+            if command == 'start':
+                self.start()
+                return {'running': True}
+            if command == 'stop':
+                return {'lanes': self.stop()}
+            if command == 'reload':
+                return self.reload(request.get('settings', {}))
+            if command == 'quit':
+                return {'lanes': self.stop()}
+        raise ValueError(f'Unknown command: {command}')
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.stop() # Before taking the lock, a swap may be waiting for it
+        with self.lock:
+            self.stop()
+            if self.motion is not None:
+                self.motion.close()
+            if self.metrics_server is not None:
+                self.metrics_server.shutdown()
+            if self.event_log is not None:
+                self.event_log.close()
+
+def lane_summary(lane):
+    summary = lane.summary()
+    summary['text'] = lane.text
+    return summary
+
+def raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def serve(daemon, socket_path):
+    if os.path.exists(socket_path):
+        os.remove(socket_path) # Stale socket from a previous run
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    print(f'Listening on {socket_path}')
+
+    # Quit cleanly on SIGTERM, e.g. from systemd
+    signal.signal(signal.SIGTERM, raise_interrupt)
+    try:
+        running = True
+        while running:
+            connection, _ = server.accept()
+            with connection, connection.makefile('rw') as stream:
+                line = stream.readline()
+                try:
+                    request = json.loads(line)
+                    reply = {'ok': True, **daemon.handle(request)}
+                    running = request.get('command') != 'quit'
+                except Exception as error:
+                    reply = {'ok': False, 'error': str(error)}
+                stream.write(json.dumps(reply) + '\n')
+                stream.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+        daemon.close()
+
+def request(socket_path, command, **arguments):
+    '''Send one command to a running daemon and return its reply.'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        with client.makefile('rw') as stream:
+            stream.write(json.dumps(dict(arguments, command=command)) + '\n')
+            stream.flush()
+            return json.loads(stream.readline())
+
+def parse_setting(text):
+    # key=value, with the value parsed as JSON when possible (numbers, lists, ...)
+    key, _, value = text.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm classifier daemon')
+    parser.add_argument('command', choices=('serve',) + COMMANDS)
+    parser.add_argument('settings', nargs='*', metavar='KEY=VALUE', help='settings for reload')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix socket path')
+    parser.add_argument('--config', help='JSON file overriding classify.py settings (serve)')
+    parser.add_argument('--idle', action='store_true', help='load the model but do not start lanes (serve)')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        settings = dict(classify.settings)
+        if args.config:
+            with open(args.config) as f:
+                settings.update(json.load(f))
+        daemon = ClassifierDaemon(settings)
+        if not args.idle:
+            daemon.start()
+        serve(daemon, args.socket)
+        return
+
+    arguments = {}
+    if args.command == 'reload':
+        arguments['settings'] = dict(parse_setting(setting) for setting in args.settings)
+    reply = request(args.socket, args.command, **arguments)
+    print(json.dumps(reply, indent=2))
+    if not reply.get('ok'):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
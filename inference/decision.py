@@ -0,0 +1,147 @@
+# Module to turn per-frame scores into one sorting decision per item
+
+'''
+A single flickering frame should not re-trigger a multi-second sort, so the
+dequantised score vectors of the last few frames are aggregated before
+deciding. Modes:
+
+    ema       Exponential moving average of the score vectors, with the
+              smoothing of an N-frame window (alpha = 2 / (window + 1))
+    majority  Top-1 label (above threshold) must win more than half the window
+    dwell     Top-1 label (above threshold) must hold for `min_dwell` frames
+
+Once a label is committed for an item, no further decision is made until
+the scene has shown "no match" for `release_frames` frames in a row, i.e.
+the item has left the view.
+
+The top-1 score is compared to the threshold of its own class, so classes
+the model is reliably right about can be accepted at lower scores. Per-class
+thresholds come from calibrate.py.
+'''
+
+import json
+import numpy as np
+
+MODES = ('ema', 'majority', 'dwell')
+NONE = -1
+
+def threshold_array(num_classes, threshold, class_thresholds=None):
+    '''`threshold` for every class, except the {class_id: threshold} overrides.'''
+    thresholds = np.full(num_classes, threshold, dtype=np.float32)
+    for class_id, class_threshold in (class_thresholds or {}).items():
+        if 0 <= class_id < num_classes:
+            thresholds[class_id] = class_threshold
+    return thresholds
+
+def apply_thresholds(scores, thresholds):
+    '''
+    Top-1 class id and score per row of `scores` (one frame or a batch),
+    with the id set to NONE where the score is under its class threshold.
+    '''
+    if scores.ndim == 1:
+        # One frame, plain indexing is cheaper than the batch path
+        class_id = int(np.argmax(scores))
+        score = float(scores[class_id])
+        return (class_id if score >= thresholds[class_id] else NONE), score
+    class_ids = np.argmax(scores, axis=1)
+    top_scores = scores[np.arange(len(scores)), class_ids]
+    return np.where(top_scores >= thresholds[class_ids], class_ids, NONE), top_scores
+
+def load_thresholds(path):
+    '''{label name: threshold} from a calibrate.py thresholds file.'''
+    with open(path) as f:
+        return json.load(f)['thresholds']
+
+class DecisionEngine:
+    def __init__(self, num_classes, mode='ema', threshold=0.8, window=5,
+                 alpha=None, min_dwell=3, release_frames=3, class_thresholds=None):
+        '''
+        `class_thresholds` maps class ids to thresholds replacing `threshold`.
+        `alpha` defaults to 2 / (window + 1), so `window` sets the EMA span too.
+        '''
+        if mode not in MODES:
+            raise ValueError(f'Unknown decision mode: {mode}')
+        self.num_classes = num_classes
+        self.mode = mode
+        self.threshold = threshold
+        self.thresholds = threshold_array(num_classes, threshold, class_thresholds)
+        self.window = max(1, window)
+        self.alpha = 2 / (self.window + 1) if alpha is None else alpha
+        self.min_dwell = max(1, min_dwell)
+        self.release_frames = max(1, release_frames)
+
+        # Preallocated state
+        self.ema = np.zeros(num_classes, dtype=np.float32)
+        self.votes = np.full(self.window, NONE, dtype=np.int64)
+        self.vote_index = 0
+        self.frames = 0
+        self.dwell_id = NONE
+        self.dwell_count = 0
+        self.committed = False
+        self.none_count = 0
+        self.candidate = (NONE, 0.0)
+
+    def reset(self):
+        self.ema[:] = 0
+        self.votes[:] = NONE
+        self.vote_index = 0
+        self.frames = 0
+        self.dwell_id = NONE
+        self.dwell_count = 0
+        self.committed = False
+        self.none_count = 0
+        self.candidate = (NONE, 0.0)
+
+    def frame_label(self, scores):
+        return apply_thresholds(scores, self.thresholds)
+
+    def aggregate(self, scores):
+        '''Return the (class_id, score) the window currently agrees on.'''
+        self.frames += 1
+        if self.mode == 'ema':
+            # Starts from zero, so a new item needs about `window` frames to reach the threshold
+            self.ema *= 1 - self.alpha
+            self.ema += self.alpha * scores
+            return self.frame_label(self.ema)
+
+        class_id, score = self.frame_label(scores)
+        if self.mode == 'majority':
+            self.votes[self.vote_index] = class_id
+            self.vote_index = (self.vote_index + 1) % self.window
+            if class_id == NONE:
+                return NONE, score
+            if np.count_nonzero(self.votes == class_id) * 2 > self.window:
+                return class_id, score
+            return NONE, score
+
+        # Dwell
+        if class_id == self.dwell_id:
+            self.dwell_count += 1
+        else:
+            self.dwell_id = class_id
+            self.dwell_count = 1
+        if class_id != NONE and self.dwell_count >= self.min_dwell:
+            return class_id, score
+        return NONE, score
+
+    def update(self, scores):
+        '''
+        Feed one frame's dequantised scores.
+
+        Returns the committed class id the first time an item is recognised,
+        otherwise None. The current aggregated candidate is kept in
+        `self.candidate` for display.
+        '''
+        class_id, score = self.aggregate(np.asarray(scores, dtype=np.float32))
+        self.candidate = (class_id, score)
+
+        if class_id == NONE:
+            self.none_count += 1
+            if self.committed and self.none_count >= self.release_frames:
+                self.committed = False # Item has left, ready for the next one
+            return None
+        self.none_count = 0
+        if self.committed:
+            return None
+        self.committed = True
+        return class_id
@@ -0,0 +1,198 @@
+# Module to detect several items per frame and track them until they are sorted
+
+'''
+Detection mode runs an SSD model instead of the whole-frame classifier, so
+several items in view are told apart. Boxes are decoded and filtered with
+vectorised NumPy, and a small IoU tracker (with a centroid fallback for
+fast moving items) keeps one stable id per physical item, so every item is
+actuated once.
+
+Boxes are (x0, y0, x1, y1), normalised to 0-1 over the model input, which
+is the whole frame (no center crop in detection mode).
+
+Supported model outputs:
+    4 tensors  TFLite_Detection_PostProcess (boxes, classes, scores, count),
+               like the Coral SSD models
+    2 tensors  Raw box encodings (1, N, 4) and class logits (1, N, classes + 1,
+               background first), decoded against an (N, 4) anchors .npy file
+'''
+
+import numpy as np
+
+BOX_SCALES = np.array([10.0, 10.0, 5.0, 5.0], dtype=np.float32) # y, x, h, w as in the TF OD API
+
+def iou_matrix(boxes_a, boxes_b):
+    '''IoU of every box in `boxes_a` with every box in `boxes_b`.'''
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    return intersection / np.maximum(area_a[:, None] + area_b[None, :] - intersection, 1e-9)
+
+def non_max_suppression(boxes, scores, iou_threshold=0.5, max_detections=10):
+    '''Indices of the boxes kept by greedy NMS, best first.'''
+    order = np.argsort(scores)[::-1]
+    keep = []
+    while len(order) and len(keep) < max_detections:
+        best = order[0]
+        keep.append(best)
+        overlaps = iou_matrix(boxes[best:best+1], boxes[order[1:]])[0]
+        order = order[1:][overlaps < iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+def decode_postprocessed(boxes, class_ids, scores, count, threshold):
+    '''Boxes, class ids and scores above `threshold` from the PostProcess outputs.'''
+    count = int(count)
+    keep = np.flatnonzero(scores[:count] >= threshold)
+    # (ymin, xmin, ymax, xmax) -> (x0, y0, x1, y1)
+    decoded = np.clip(boxes[keep][:, [1, 0, 3, 2]], 0.0, 1.0).astype(np.float32)
+    return decoded, class_ids[keep].astype(np.int64), scores[keep].astype(np.float32)
+
+def decode_raw(encodings, logits, anchors, threshold, iou_threshold=0.5, max_detections=10):
+    '''Decode center-size box encodings against (ycenter, xcenter, h, w) anchors.'''
+    encodings = encodings / BOX_SCALES
+    y_center = encodings[:, 0] * anchors[:, 2] + anchors[:, 0]
+    x_center = encodings[:, 1] * anchors[:, 3] + anchors[:, 1]
+    half_height = np.exp(encodings[:, 2]) * anchors[:, 2] / 2
+    half_width = np.exp(encodings[:, 3]) * anchors[:, 3] / 2
+    boxes = np.stack([x_center - half_width, y_center - half_height,
+                      x_center + half_width, y_center + half_height], axis=1)
+    scores = 1 / (1 + np.exp(-logits[:, 1:])) # Drop the background class
+    class_ids = np.argmax(scores, axis=1)
+    best = scores[np.arange(len(scores)), class_ids]
+    candidates = np.flatnonzero(best >= threshold)
+    keep = candidates[non_max_suppression(boxes[candidates], best[candidates],
+                                          iou_threshold, max_detections)]
+    return (np.clip(boxes[keep], 0.0, 1.0).astype(np.float32), class_ids[keep].astype(np.int64),
+            best[keep].astype(np.float32))
+
+class Detector:
+    def __init__(self, backend, threshold=0.5, anchors=None, iou_threshold=0.5, max_detections=10):
+        '''
+        `backend` is an Edge TPU or CPU backend loaded with an SSD model,
+        `anchors` an (N, 4) array, only needed for raw outputs.
+        '''
+        if not hasattr(backend, 'interpreter'):
+            raise ValueError(f'{backend.describe()} has no interpreter to run a detection model on')
+        self.backend = backend
+        self.threshold = threshold
+        self.anchors = anchors
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+        self.outputs = backend.interpreter.get_output_details()
+        shapes = [tuple(output['shape']) for output in self.outputs]
+        if len(self.outputs) == 4:
+            # Same output order detection as pycoral.adapters.detect
+            if np.prod(shapes[3]) == 1:
+                self.order = (0, 1, 2, 3) # boxes, classes, scores, count
+            else:
+                self.order = (1, 3, 0, 2)
+        elif len(self.outputs) == 2 and anchors is not None:
+            self.order = (0, 1) if shapes[0][-1] == 4 else (1, 0) # encodings, logits
+            if shapes[self.order[0]][1] != len(anchors):
+                raise ValueError(f'{len(anchors)} anchors for {shapes[self.order[0]][1]} boxes')
+        else:
+            raise ValueError(f'Not an SSD detection model (outputs {shapes}), '
+                             'or raw outputs without an anchors file')
+
+    def output(self, index):
+        details = self.outputs[index]
+        tensor = self.backend.interpreter.get_tensor(details['index'])[0]
+        scale, zero_point = details['quantization']
+        if scale:
+            return (tensor.astype(np.float32) - zero_point) * scale
+        return tensor
+
+    def detect(self):
+        '''(boxes, class_ids, scores) of the last invoke().'''
+        if len(self.order) == 4:
+            boxes, class_ids, scores, count = (self.output(index) for index in self.order)
+            return decode_postprocessed(boxes, class_ids, scores, np.ravel(count)[0], self.threshold)
+        encodings, logits = (self.output(index) for index in self.order)
+        return decode_raw(encodings, logits, self.anchors, self.threshold,
+                          self.iou_threshold, self.max_detections)
+
+class Track:
+    __slots__ = ('id', 'box', 'class_scores', 'hits', 'missed', 'actuated')
+
+    def __init__(self, track_id, box, num_classes):
+        self.id = track_id
+        self.box = box
+        self.class_scores = np.zeros(num_classes, dtype=np.float32) # Summed over hits
+        self.hits = 0
+        self.missed = 0
+        self.actuated = False
+
+    def label(self):
+        '''Best class over the track's life and its mean score.'''
+        class_id = int(np.argmax(self.class_scores))
+        return class_id, float(self.class_scores[class_id] / max(self.hits, 1))
+
+class Tracker:
+    def __init__(self, num_classes, iou_threshold=0.3, max_distance=0.15, max_missed=5):
+        '''
+        Detections join the track they overlap most (IoU at least
+        `iou_threshold`), else the nearest one within `max_distance` (in
+        frame widths). Tracks unseen for `max_missed` frames are dropped.
+        '''
+        self.num_classes = num_classes
+        self.iou_threshold = iou_threshold
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.tracks = []
+        self.next_id = 1
+
+    def match(self, cost, limit, higher_is_better, free_tracks, free_detections):
+        # Greedy assignment of the best pairs first
+        pairs = []
+        if cost.size:
+            order = np.argsort(-cost if higher_is_better else cost, axis=None)
+            for flat in order:
+                track, detection = np.unravel_index(flat, cost.shape)
+                value = cost[track, detection]
+                if (value < limit) if higher_is_better else (value > limit):
+                    break
+                if track in free_tracks and detection in free_detections:
+                    free_tracks.discard(track)
+                    free_detections.discard(detection)
+                    pairs.append((track, detection))
+        return pairs
+
+    def update(self, boxes, class_ids, scores):
+        '''Feed one frame's detections, return the live tracks.'''
+        known = class_ids < self.num_classes # Ids without a label are ignored
+        boxes, class_ids, scores = boxes[known], class_ids[known], scores[known]
+        free_tracks = set(range(len(self.tracks)))
+        free_detections = set(range(len(boxes)))
+        pairs = []
+        if self.tracks and len(boxes):
+            track_boxes = np.array([track.box for track in self.tracks], dtype=np.float32)
+            pairs += self.match(iou_matrix(track_boxes, boxes), self.iou_threshold, True,
+                                free_tracks, free_detections)
+            if free_tracks and free_detections:
+                track_centres = (track_boxes[:, :2] + track_boxes[:, 2:]) / 2
+                centres = (boxes[:, :2] + boxes[:, 2:]) / 2
+                distances = np.linalg.norm(track_centres[:, None] - centres[None], axis=2)
+                # Pairs already matched by IoU are excluded by the free sets
+                pairs += self.match(distances, self.max_distance, False, free_tracks, free_detections)
+
+        for track_index, detection in pairs:
+            track = self.tracks[track_index]
+            track.box = boxes[detection]
+            track.class_scores[class_ids[detection]] += scores[detection]
+            track.hits += 1
+            track.missed = 0
+        for track_index in free_tracks:
+            self.tracks[track_index].missed += 1
+        for detection in sorted(free_detections):
+            track = Track(self.next_id, boxes[detection], self.num_classes)
+            track.class_scores[class_ids[detection]] += scores[detection]
+            track.hits = 1
+            self.next_id += 1
+            self.tracks.append(track)
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+        return self.tracks
+
+    def reset(self):
+        self.tracks = []
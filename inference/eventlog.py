@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# Module to log every decision to fixed-size binary records
+
+'''
+Records go into pre-sized, memory-mapped segment files that are rotated once
+full, so logging a decision is a few stores into the mapping instead of a
+formatted print. Each segment is a 64 byte header (magic, record size,
+capacity, records written) followed by RECORD records:
+
+    kind         DECISION when the lane commits an item, ACTUATED when the
+                 motion process finished the matching command (same seq)
+    time         Wall clock, seconds since the epoch
+    lane         Lane index
+    class_id     Committed class, score its aggregated score
+    top_ids      Top-k class ids and scores of the committing frame
+    bin          Bin the item was sent to, 0 when it stayed
+    seq          MotionController command number, 0 when nothing moved
+    duration     Actuation time in seconds (ACTUATED records)
+
+Reading maps the segments as NumPy structured arrays, e.g.
+
+    records = eventlog.read_log('events')
+    np.bincount(records['class_id'][records['kind'] == eventlog.DECISION])
+
+    python3 eventlog.py events           # Summary
+    python3 eventlog.py events --csv     # Every record as CSV
+'''
+
+import argparse
+import glob
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import numpy as np
+
+# Define constants
+MAGIC = b'CLBNEVT1'
+HEADER = struct.Struct('<8sIIQ') # Magic, record size, capacity, count
+HEADER_SIZE = 64
+TOP_K = 3
+DECISION = 1
+ACTUATED = 2
+
+RECORD = np.dtype([
+    ('time', '<f8'),
+    ('seq', '<u4'),
+    ('score', '<f4'),
+    ('duration', '<f4'),
+    ('top_scores', '<f4', (TOP_K,)),
+    ('class_id', '<i2'),
+    ('top_ids', '<i2', (TOP_K,)),
+    ('kind', 'u1'),
+    ('lane', 'u1'),
+    ('bin', 'i1'),
+    ('reserved', 'V5'), # Pads records to 48 bytes
+])
+
+def segment_paths(directory):
+    return sorted(glob.glob(os.path.join(directory, 'events-*.bin')))
+
+class EventLog:
+    def __init__(self, directory, segment_records=65536, keep_segments=64):
+        '''
+        Each segment holds `segment_records` records (3 MB by default), and
+        only the newest `keep_segments` are kept (None keeps them all).
+        '''
+        self.directory = directory
+        self.segment_records = segment_records
+        self.keep_segments = keep_segments
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+        self.records = None
+        self.count = 0
+        os.makedirs(directory, exist_ok=True)
+        paths = segment_paths(directory)
+        self.segment = int(os.path.basename(paths[-1])[7:-4]) if paths else 0
+        self.open_segment()
+
+    def open_segment(self):
+        # Always start a fresh segment, older ones are never written again
+        self.segment += 1
+        path = os.path.join(self.directory, f'events-{self.segment:06d}.bin')
+        self.file = open(path, 'w+b')
+        self.file.truncate(HEADER_SIZE + self.segment_records * RECORD.itemsize)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        HEADER.pack_into(self.map, 0, MAGIC, RECORD.itemsize, self.segment_records, 0)
+        self.records = np.frombuffer(self.map, RECORD, self.segment_records, HEADER_SIZE)
+        self.count = 0
+        self.remove_old_segments()
+
+    def close_segment(self):
+        self.records = None # Release the NumPy view before closing the mapping
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+    def remove_old_segments(self):
+        if self.keep_segments is None:
+            return
+        for path in segment_paths(self.directory)[:-self.keep_segments]:
+            os.remove(path)
+
+    def append(self, kind, lane=0, class_id=-1, score=0.0, top_ids=(), top_scores=(),
+               bin=0, seq=0, duration=0.0):
+        with self.lock:
+            if self.records is None:
+                return # Closed
+            if self.count == self.segment_records:
+                self.close_segment()
+                self.open_segment()
+            top_ids = list(top_ids)[:TOP_K]
+            top_scores = list(top_scores)[:TOP_K]
+            self.records[self.count] = (
+                time.time(), seq, score, duration,
+                top_scores + [0.0] * (TOP_K - len(top_scores)), class_id,
+                top_ids + [-1] * (TOP_K - len(top_ids)), kind, lane, bin, b'')
+            # Count last, so readers never see a half-written record
+            self.count += 1
+            struct.pack_into('<Q', self.map, HEADER.size - 8, self.count)
+
+    def log_decision(self, lane, scores, class_id, score, position=None, seq=None):
+        top_ids = np.argsort(scores)[::-1][:TOP_K]
+        self.append(DECISION, lane=lane, class_id=class_id, score=score,
+                    top_ids=top_ids, top_scores=scores[top_ids],
+                    bin=position or 0, seq=seq or 0)
+
+    def log_report(self, report):
+        # MotionController report, only sorts are matched to decisions
+        if report.get('event') == 'done' and report['command'] == 'sort':
+            self.append(ACTUATED, bin=report['position'] or 0, seq=report['seq'],
+                        duration=report['duration'])
+
+    def close(self):
+        with self.lock:
+            if self.records is not None:
+                self.close_segment()
+
+def read_segment(path):
+    '''Written records of one segment, as a read-only memory-mapped array.'''
+    with open(path, 'rb') as f:
+        magic, record_size, capacity, count = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or record_size != RECORD.itemsize:
+        raise ValueError(f'{path} is not a classibin event log segment')
+    if count == 0:
+        return np.zeros(0, RECORD)
+    return np.memmap(path, RECORD, 'r', HEADER_SIZE, (count,))
+
+def read_log(directory):
+    '''Every record in `directory`, oldest first.'''
+    segments = [read_segment(path) for path in segment_paths(directory)]
+    if not segments:
+        return np.zeros(0, RECORD)
+    return np.concatenate(segments) if len(segments) > 1 else segments[0]
+
+def summarise(records, labels=None):
+    decisions = records[records['kind'] == DECISION]
+    actuated = records[records['kind'] == ACTUATED]
+    print(f'{len(decisions)} decisions, {len(actuated)} actuations')
+    if len(records):
+        start, end = records['time'].min(), records['time'].max()
+        print(f"From {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))} "
+              f"to {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end))}")
+    class_ids = decisions['class_id']
+    for class_id in np.unique(class_ids):
+        mask = class_ids == class_id
+        name = labels.get(int(class_id), class_id) if labels else class_id
+        print(f'{name}: {mask.sum()} decisions, mean score {decisions["score"][mask].mean() * 100:.1f}%')
+    for position in np.unique(actuated['bin']):
+        durations = actuated['duration'][actuated['bin'] == position]
+        print(f'Bin {position}: {len(durations)} sorts, '
+              f'{durations.mean():.2f} s mean, {durations.max():.2f} s max')
+
+def write_csv(records, stream):
+    stream.write('time,kind,lane,class_id,score,top_ids,top_scores,bin,seq,duration\n')
+    for record in records:
+        stream.write(f"{record['time']:.6f},{record['kind']},{record['lane']},{record['class_id']},"
+                     f"{record['score']:.4f},{' '.join(map(str, record['top_ids']))},"
+                     f"{' '.join(f'{s:.4f}' for s in record['top_scores'])},"
+                     f"{record['bin']},{record['seq']},{record['duration']:.4f}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description='Read the classification event log')
+    parser.add_argument('directory', help='event log directory')
+    parser.add_argument('--labels', help='label file, to print class names')
+    parser.add_argument('--csv', action='store_true', help='print every record as CSV')
+    args = parser.parse_args()
+
+    records = read_log(args.directory)
+    if args.csv:
+        write_csv(records, sys.stdout)
+        return
+    labels = None
+    if args.labels:
+        from pycoral.utils.dataset import read_label_file
+        labels = read_label_file(args.labels)
+    summarise(records, labels)
+
+if __name__ == '__main__':
+    main()
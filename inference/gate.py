@@ -0,0 +1,67 @@
+# Module to skip inference while the scene under the camera is not changing
+
+import time
+import cv2
+import numpy as np
+
+class ChangeGate:
+    '''
+    Cheap change detector on a heavily downscaled grayscale frame.
+
+    A frame is let through when it differs from the reference frame by more
+    than `threshold` (mean absolute difference, 0-255), and again once the
+    scene has settled (`settle_frames` quiet frames after a change), so the
+    item is classified while it is still. While the scene is static, only
+    one frame every 1/`idle_fps` seconds is let through.
+    '''
+    def __init__(self, threshold=6.0, size=(32, 24), settle_frames=3, idle_fps=1.0):
+        self.threshold = threshold
+        self.size = tuple(size)
+        self.settle_frames = settle_frames
+        self.idle_interval = 1 / idle_fps if idle_fps > 0 else None
+
+        # Preallocated buffers
+        shape = (self.size[1], self.size[0])
+        self.small = np.empty(shape + (3,), dtype=np.uint8)
+        self.gray = np.empty(shape, dtype=np.uint8)
+        self.reference = np.empty(shape, dtype=np.uint8)
+        self.diff = np.empty(shape, dtype=np.uint8)
+
+        self.has_reference = False
+        self.quiet_count = 0
+        self.last_pass = 0
+        self.passed = 0
+        self.skipped = 0
+
+    def difference(self, frame):
+        cv2.resize(frame, self.size, dst=self.small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        if not self.has_reference:
+            self.reference[:] = self.gray
+            self.has_reference = True
+            return float('inf')
+        cv2.absdiff(self.gray, self.reference, dst=self.diff)
+        self.reference[:] = self.gray
+        return float(cv2.mean(self.diff)[0])
+
+    def check(self, frame, now=None):
+        '''Return True when the frame should go to the interpreter.'''
+        if now is None:
+            now = time.monotonic()
+        changed = self.difference(frame) > self.threshold
+        if changed:
+            self.quiet_count = 0
+            passing = True
+        else:
+            self.quiet_count += 1
+            if self.quiet_count <= self.settle_frames:
+                passing = True # Still settling, keep looking
+            else:
+                passing = (self.idle_interval is not None
+                           and now - self.last_pass >= self.idle_interval)
+        if passing:
+            self.last_pass = now
+            self.passed += 1
+        else:
+            self.skipped += 1
+        return passing
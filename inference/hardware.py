@@ -0,0 +1,203 @@
+# Module to pick the GPIO implementation: RPi.GPIO on a Pi, or an explicitly chosen simulator
+
+'''
+motor.py gets `GPIO` and `clock` from load() instead of importing RPi.GPIO
+and calling time.sleep() directly. Set CLASSIBIN_GPIO to choose:
+
+    rpi   RPi.GPIO and the real clock (default), fails off a Pi
+    sim   SimGPIO on a VirtualClock: sleeps return at once, every pin
+          transition is recorded with its virtual timestamp
+    auto  rpi when RPi.GPIO can be imported, otherwise sim with a warning
+
+The simulator is never picked silently: on a Pi with a broken RPi.GPIO
+setup the motors would not move while sorts are still logged and counted.
+
+With the simulator, a sortPos() cycle that takes seconds on the rig runs in
+milliseconds and its waveform can be inspected or exported:
+
+    CLASSIBIN_GPIO=sim python3 -c "import motor; motor.sortPos(4); motor.GPIO.export_vcd('sort.vcd')"
+'''
+
+import os
+import sys
+import time
+
+class RealClock:
+    spin_margin = 0.0002 # Busy-wait the last part of a deadline for accuracy
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def sleep_until(self, deadline):
+        # Sleep most of the way, then spin to the absolute deadline
+        remaining = deadline - time.monotonic()
+        if remaining > self.spin_margin:
+            time.sleep(remaining - self.spin_margin)
+        while time.monotonic() < deadline:
+            pass
+
+class VirtualClock:
+    '''
+    Clock that only moves when slept on. `sleep_overshoot` is added to every
+    sleep to mimic scheduler latency on a loaded Pi.
+    '''
+    def __init__(self, sleep_overshoot=0.0):
+        self.now = 0.0
+        self.sleep_overshoot = sleep_overshoot
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += max(0.0, seconds)
+
+    def sleep(self, seconds):
+        self.advance(seconds + self.sleep_overshoot)
+
+    def sleep_until(self, deadline):
+        if deadline > self.now:
+            self.advance(deadline - self.now + self.sleep_overshoot)
+
+class SimPWM:
+    def __init__(self, gpio, channel, frequency):
+        self.gpio = gpio
+        self.channel = channel
+        self.frequency = frequency
+        self.duty = 0
+
+    def start(self, duty):
+        self.ChangeDutyCycle(duty)
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = duty
+        self.gpio.record(f'pwm{self.channel}', duty)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+
+class SimGPIO:
+    '''
+    Stand-in for the parts of RPi.GPIO used in inference/. Every change of an
+    output (or PWM duty cycle) is kept in `events` as (time, signal, value).
+    `output_cost` is the virtual time a GPIO.output() call takes per pin.
+    '''
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, clock, output_cost=0.0):
+        self.clock = clock
+        self.output_cost = output_cost
+        self.mode = None
+        self.pins = {}
+        self.events = []
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, channel, direction, initial=None):
+        for pin in self.channels(channel):
+            self.pins.setdefault(pin, self.LOW)
+            if initial is not None:
+                self.output(pin, initial)
+
+    def channels(self, channel):
+        return list(channel) if isinstance(channel, (list, tuple)) else [channel]
+
+    def output(self, channel, value):
+        pins = self.channels(channel)
+        values = list(value) if isinstance(value, (list, tuple)) else [value] * len(pins)
+        if len(values) != len(pins):
+            raise ValueError('Number of channels and values differ')
+        # All pins of one call change together, then the call takes its time
+        for pin, state in zip(pins, values):
+            state = 1 if state else 0
+            if self.pins.get(pin) != state:
+                self.pins[pin] = state
+                self.record(pin, state)
+        self.clock.advance(self.output_cost * len(pins))
+
+    def input(self, channel):
+        return self.pins.get(channel, self.LOW)
+
+    def PWM(self, channel, frequency):
+        return SimPWM(self, channel, frequency)
+
+    def cleanup(self, channel=None):
+        for pin in (self.channels(channel) if channel is not None else list(self.pins)):
+            self.output(pin, self.LOW)
+
+    def record(self, signal, value):
+        self.events.append((self.clock.monotonic(), signal, value))
+
+    def reset(self):
+        self.events = []
+
+    def transitions(self, pins, start=0):
+        '''Times at which any of `pins` changed, from event index `start` on.'''
+        pins = set(pins)
+        times = []
+        for timestamp, signal, value in self.events[start:]:
+            if signal in pins and (not times or times[-1] != timestamp):
+                times.append(timestamp)
+        return times
+
+    def export_csv(self, path):
+        with open(path, 'w') as f:
+            f.write('time,signal,value\n')
+            for timestamp, signal, value in self.events:
+                f.write(f'{timestamp:.9f},{signal},{value}\n')
+
+    def export_vcd(self, path):
+        '''Write the waveform as a Value Change Dump, e.g. for GTKWave.'''
+        signals = sorted({signal for _, signal, _ in self.events}, key=str)
+        ids = {signal: chr(33 + index) for index, signal in enumerate(signals)}
+        with open(path, 'w') as f:
+            f.write('$timescale 1us $end\n$scope module gpio $end\n')
+            for signal in signals:
+                if str(signal).startswith('pwm'):
+                    f.write(f'$var real 64 {ids[signal]} {signal} $end\n')
+                else:
+                    f.write(f'$var wire 1 {ids[signal]} gpio{signal} $end\n')
+            f.write('$upscope $end\n$enddefinitions $end\n')
+            last_time = None
+            for timestamp, signal, value in self.events:
+                microseconds = round(timestamp * 1e6)
+                if microseconds != last_time:
+                    f.write(f'#{microseconds}\n')
+                    last_time = microseconds
+                if str(signal).startswith('pwm'):
+                    f.write(f'r{value} {ids[signal]}\n')
+                else:
+                    f.write(f'{value}{ids[signal]}\n')
+
+def load(kind=None):
+    '''Return (GPIO, clock) for `kind`, or CLASSIBIN_GPIO when not given.'''
+    kind = kind or os.environ.get('CLASSIBIN_GPIO', 'rpi')
+    if kind not in ('auto', 'rpi', 'sim'):
+        raise ValueError(f'Unknown GPIO backend: {kind}')
+    if kind in ('auto', 'rpi'):
+        try:
+            import RPi.GPIO as gpio
+            return gpio, RealClock()
+        except (ImportError, RuntimeError) as error:
+            # RPi.GPIO raises RuntimeError when not running on a Pi
+            if kind == 'rpi':
+                raise RuntimeError(f'RPi.GPIO unavailable ({error}), '
+                                   'set CLASSIBIN_GPIO=sim to run on the simulator') from error
+            print(f'WARNING: RPi.GPIO unavailable ({error}), using the GPIO simulator. '
+                  'The motors will NOT move.', file=sys.stderr, flush=True)
+    clock = VirtualClock()
+    return SimGPIO(clock), clock
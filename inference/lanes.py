@@ -0,0 +1,378 @@
+# Module to run several sorting lanes in one process
+
+'''
+A lane is one camera, one inference backend and one actuator set, running its own
+capture -> preprocess -> inference -> actuate pipeline. The device scheduler
+hands every lane an Edge TPU while there are free ones and gives the rest
+CPU interpreters that share the cores between them.
+'''
+
+import os
+import threading
+import time
+import numpy as np
+import metrics
+from capture import FrameGrabber
+from gate import ChangeGate
+from decision import DecisionEngine, NONE, threshold_array
+from detection import Detector, Tracker
+from pipeline import Pipeline, Stage, StageStats
+from preprocess import Preprocessor
+from backends import make_backend
+
+# Define constants
+CONFIRM_FRAMES = 30 # Frames a swapped-in model runs before the previous one is released
+
+class LaneModel:
+    '''
+    The backend, labels and decision state a frame is inferred and decided
+    with. Items carry it from inference to actuation, so a model swap never
+    mixes one model's scores with another's labels.
+    '''
+    __slots__ = ('backend', 'labels', 'class_thresholds', 'decision')
+
+    def __init__(self, backend, labels, class_thresholds, decision):
+        self.backend = backend
+        self.labels = labels
+        self.class_thresholds = class_thresholds
+        self.decision = decision # DecisionEngine, or (thresholds, Tracker) in a DetectionLane
+
+class Lane:
+    def __init__(self, name, source, backend, labels, actuator=None, sort_bins=None,
+                 threshold=0.8, decision_mode='ema', decision_window=5,
+                 change_threshold=6, idle_fps=1, event_log=None, class_thresholds=None,
+                 queue_policy='drop_oldest', keep_samples=False):
+        '''
+        `source` is a cv2.VideoCapture-like object, `backend` one of the
+        backends in backends.py and `actuator` a function taking a bin
+        position and returning a command number, None when nothing was
+        sent, e.g. MotionController.sort. Without an actuator the lane only
+        classifies. `event_log(scores, class_id, score, position, seq)` is
+        called for every decision, see eventlog.py. `class_thresholds` maps
+        label names to thresholds replacing `threshold`, see calibrate.py.
+        `queue_policy` 'block' processes every frame instead of the newest
+        (replays), `keep_samples` keeps stage and latency durations for
+        percentiles, see benchmark.py.
+        '''
+        self.name = name
+        self.actuator = actuator
+        self.sort_bins = sort_bins or {}
+        self.event_log = event_log
+        # Metric children are looked up once here, not per frame
+        self.score_histogram = metrics.inference_score.labels(name)
+        self.latency = StageStats(keep_samples, metrics.frame_latency.labels(name)) # Capture to decision
+        # Steps inside the camera thread and the pipeline stages, timed on their own
+        self.step_stats = {step: StageStats(keep_samples, metrics.stage_latency.labels(name, step))
+                           for step in ('capture', 'postprocess', 'decision')}
+        self.camera = FrameGrabber(source, block=queue_policy == 'block',
+                                   stats=self.step_stats['capture'])
+        self.preprocessor = Preprocessor(backend.input_size())
+        # Keep inferring after a change until the decision window has filled
+        self.change_gate = ChangeGate(threshold=change_threshold, settle_frames=decision_window,
+                                      idle_fps=idle_fps)
+        self.decision_options = {'mode': decision_mode, 'threshold': threshold,
+                                 'window': decision_window, 'min_dwell': decision_window}
+        class_thresholds = class_thresholds or {}
+        self.model = LaneModel(backend, labels, class_thresholds,
+                               self.make_decision(backend, labels, class_thresholds))
+        # Swaps are handed over by the watcher thread and applied by the inference thread
+        self.swap_lock = threading.Lock()
+        self.pending = None # LaneModel to switch to before the next frame
+        self.previous = None # LaneModel until a swapped model is confirmed
+        self.confirm_frames = 0
+        self.last_input = None
+        self.text = "--.--% - no match"
+        self.decisions = 0
+        stage_names = ('grab', 'preprocess', 'inference', 'actuate')
+        self.pipeline = Pipeline(self.read_frame, [
+            Stage('preprocess', self.preprocess, maxsize=1, policy=queue_policy),
+            Stage('inference', self.infer, maxsize=1, policy=queue_policy),
+            Stage('actuate', self.actuate, maxsize=1, policy=queue_policy),
+        ], source_name='grab', keep_samples=keep_samples,
+           histograms={stage: metrics.stage_latency.labels(name, stage) for stage in stage_names})
+        self.start_time = 0
+        self.rate_time = 0
+        self.rate_counts = (0, 0)
+
+    @property
+    def backend(self):
+        return self.model.backend
+
+    @property
+    def labels(self):
+        return self.model.labels
+
+    def make_decision(self, backend, labels, class_thresholds, current=None):
+        # Keep the current engine, and what it has seen, if nothing it depends on changed
+        if (current is not None and backend.num_classes() == current.backend.num_classes()
+                and labels == current.labels and class_thresholds == current.class_thresholds):
+            return current.decision
+        ids = {name: class_id for class_id, name in labels.items()}
+        class_thresholds = {ids[name]: threshold for name, threshold in class_thresholds.items()
+                            if name in ids}
+        return DecisionEngine(backend.num_classes(), class_thresholds=class_thresholds,
+                              **self.decision_options)
+
+    # Pipeline stages, items carry the capture time for the glass-to-decision latency
+    def read_frame(self):
+        # Picture from camera
+        frame, timestamp = self.camera.read_with_timestamp()
+        if frame is None:
+            return None
+        return timestamp, frame
+
+    def preprocess(self, item):
+        timestamp, frame = item
+        # Skip the interpreter while nothing moves under the camera
+        if not self.change_gate.check(frame):
+            return None
+        # Crop, resize and convert into a reused buffer
+        return timestamp, self.preprocessor(frame)
+
+    def infer(self, item):
+        timestamp, cv2_im_rgb = item
+        # Switch models between two frames, on this thread only
+        if self.pending is not None:
+            with self.swap_lock:
+                pending, self.pending = self.pending, None
+            self.previous = self.model
+            self.model = pending
+            self.confirm_frames = 0
+
+        # Run inference
+        model = self.model
+        self.last_input = cv2_im_rgb
+        try:
+            model.backend.set_input(cv2_im_rgb)
+            model.backend.invoke()
+            start_time = time.perf_counter()
+            result = self.read_output(model.backend)
+            self.step_stats['postprocess'].add(time.perf_counter() - start_time)
+        except Exception as error:
+            if self.previous is None:
+                raise
+            self.rollback(error)
+            return self.infer(item)
+        if self.previous is not None:
+            self.confirm_frames += 1
+            if self.confirm_frames >= CONFIRM_FRAMES:
+                self.previous = None # New model confirmed, release the old interpreter
+        return timestamp, model, result
+
+    def read_output(self, backend):
+        scores = backend.get_scores()
+        if self.previous is not None and not np.all(np.isfinite(scores)):
+            raise ValueError('non-finite scores')
+        self.score_histogram.observe(float(scores.max()))
+        return scores
+
+    def actuate(self, item):
+        # Process results with the model that inferred them, aggregated over the last few frames
+        timestamp, model, scores = item
+        decision_engine = model.decision
+        start_time = time.perf_counter()
+        decision = decision_engine.update(scores)
+        self.step_stats['decision'].add(time.perf_counter() - start_time)
+        self.latency.add(time.monotonic() - timestamp)
+        class_id, object_score = decision_engine.candidate
+        if class_id == NONE:
+            self.text = "--.--% - no match"
+        else:
+            self.text = f"{object_score * 100:.2f}% - {model.labels.get(class_id)}"
+
+        # Action, once per item
+        if decision is not None:
+            self.sort(model.labels, decision, object_score, scores)
+
+    def sort(self, labels, class_id, score, scores):
+        self.decisions += 1
+        position = self.sort_bins.get(labels.get(class_id))
+        seq = None
+        if (self.actuator is not None) and (position is not None):
+            seq = self.actuator(position) # MotionController.sort returns a command number, None if not sent
+        if seq is not None:
+            metrics.actuations.labels(self.name, position).inc()
+        else:
+            position = None
+        if self.event_log is not None:
+            self.event_log(scores, class_id, score, position, seq)
+
+    def swap_backend(self, backend, labels, class_thresholds=None):
+        '''
+        Use `backend` and `labels` from the next frame on, see reloader.py.
+        Called from the watcher thread, the inference thread switches over.
+        '''
+        with self.swap_lock:
+            current = self.pending or self.model
+            if class_thresholds is None:
+                class_thresholds = current.class_thresholds
+            self.pending = LaneModel(backend, labels, class_thresholds,
+                                     self.make_decision(backend, labels, class_thresholds, current))
+
+    def rollback(self, error):
+        # Inference thread only
+        print(f'\n{self.name}: new model failed ({error}), rolling back')
+        self.model = self.previous
+        self.previous = None
+
+    def start(self):
+        self.start_time = self.rate_time = time.monotonic()
+        self.camera.start()
+        self.pipeline.start()
+        metrics.registry.add_collector(self.name, self.collect)
+        return self
+
+    def stop(self):
+        metrics.registry.remove_collector(self.name)
+        self.pipeline.stop()
+        self.camera.release()
+
+    def join(self):
+        self.pipeline.join()
+
+    def is_alive(self):
+        return self.pipeline.is_alive()
+
+    def timings(self):
+        '''
+        Timing summary of every step in milliseconds: camera read (capture),
+        the pipeline stages, and postprocess and decision, which are also
+        part of the inference and actuate stages.
+        '''
+        timings = self.pipeline.timings()
+        timings.update((step, stats.summary()) for step, stats in self.step_stats.items())
+        timings['capture']['dropped'] = self.camera.dropped
+        order = ('capture', 'grab', 'preprocess', 'inference', 'postprocess', 'actuate', 'decision')
+        return {name: timings[name] for name in order}
+
+    def samples(self, name):
+        '''Recorded durations of a step in seconds (needs keep_samples).'''
+        if name in self.step_stats:
+            return self.step_stats[name].durations()
+        return self.pipeline.samples(name)
+
+    def fps(self):
+        '''Capture and inference frame rates since the previous call.'''
+        timings = self.timings()
+        counts = (timings['capture']['count'], timings['inference']['count'])
+        now = time.monotonic()
+        elapsed = max(now - self.rate_time, 1e-6)
+        rates = tuple((new - old) / elapsed for new, old in zip(counts, self.rate_counts))
+        self.rate_time = now
+        self.rate_counts = counts
+        return rates
+
+    def summary(self):
+        timings = self.timings()
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        return {
+            'lane': self.name,
+            'device': self.backend.describe(),
+            'capture_fps': timings['capture']['count'] / elapsed,
+            'inference_fps': timings['inference']['count'] / elapsed,
+            'captured': self.camera.captured,
+            'dropped': self.camera.dropped,
+            'skipped': self.change_gate.skipped,
+            'decisions': self.decisions,
+            'timings': timings,
+        }
+
+    def collect(self):
+        '''Lane counters for metrics.registry, read when scraped.'''
+        timings = self.timings()
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        labels = {'lane': self.name}
+        yield ('classibin_frames_captured_total', 'counter', 'Frames read from the camera',
+               labels, self.camera.captured)
+        yield ('classibin_frames_dropped_total', 'counter',
+               'Frames overwritten before use, by the camera thread or a full stage queue',
+               labels, sum(timing['dropped'] for timing in timings.values()))
+        yield ('classibin_frames_skipped_total', 'counter', 'Static frames skipped by the change gate',
+               labels, self.change_gate.skipped)
+        yield ('classibin_frames_inferred_total', 'counter', 'Frames run through the interpreter',
+               labels, timings['inference']['count'])
+        yield ('classibin_decisions_total', 'counter', 'Items committed by the decision engine',
+               labels, self.decisions)
+        for stage in ('capture', 'inference'):
+            yield (f'classibin_{stage}_fps', 'gauge', f'Average {stage} frame rate since the lane started',
+                   labels, timings[stage]['count'] / elapsed)
+
+class DetectionLane(Lane):
+    '''
+    Lane running an SSD model, see detection.py. Every tracked item is
+    sorted once, when it has been seen for `decision_window` frames and its
+    mean score passes the threshold of its class.
+    '''
+    def __init__(self, name, source, backend, labels, detection_threshold=0.5, anchors=None,
+                 **options):
+        self.detection_threshold = detection_threshold
+        self.anchors = anchors
+        self.detectors = {}
+        super().__init__(name, source, backend, labels, **options)
+        self.preprocessor = Preprocessor(backend.input_size(), crop=False) # Whole view
+        self.detector(backend) # Fail early on a model that is not a detector
+        self.text = "0 items"
+
+    def make_decision(self, backend, labels, class_thresholds, current=None):
+        # (thresholds, tracker), the tracker survives a swap with the same number of labels
+        ids = {name: class_id for class_id, name in labels.items()}
+        thresholds = threshold_array(len(labels), self.decision_options['threshold'],
+                                     {ids[name]: threshold for name, threshold
+                                      in class_thresholds.items() if name in ids})
+        if current is not None and len(current.labels) == len(labels):
+            return thresholds, current.decision[1]
+        return thresholds, Tracker(len(labels))
+
+    def detector(self, backend):
+        # One Detector per backend, rebuilt after a model swap
+        detector = self.detectors.get(backend)
+        if detector is None:
+            detector = Detector(backend, self.detection_threshold, self.anchors)
+            self.detectors = {backend: detector}
+        return detector
+
+    def read_output(self, backend):
+        detections = self.detector(backend).detect()
+        for score in detections[2]:
+            self.score_histogram.observe(float(score))
+        return detections
+
+    def actuate(self, item):
+        timestamp, model, detections = item
+        thresholds, tracker = model.decision
+        start_time = time.perf_counter()
+        tracks = tracker.update(*detections)
+        self.step_stats['decision'].add(time.perf_counter() - start_time)
+        self.latency.add(time.monotonic() - timestamp)
+        self.text = f"{len(tracks)} items"
+        for track in tracks:
+            if track.actuated or track.missed or track.hits < self.decision_options['window']:
+                continue
+            class_id, score = track.label()
+            if score >= thresholds[class_id]:
+                track.actuated = True # Once per item, even if it stays in view
+                self.text = f"{score * 100:.2f}% - {model.labels.get(class_id)} #{track.id}"
+                self.sort(model.labels, class_id, score, track.class_scores / track.hits)
+
+def schedule_devices(num_lanes, tpus, cpu_count=None):
+    '''
+    Assign each lane ('edgetpu', device) while Edge TPUs last, then
+    ('cpu', num_threads) with the cores split between the CPU lanes.
+    '''
+    assignments = [('edgetpu', device) for device in tpus[:num_lanes]]
+    cpu_lanes = num_lanes - len(assignments)
+    if cpu_lanes > 0:
+        threads = max(1, (cpu_count or os.cpu_count() or 1) // cpu_lanes)
+        assignments += [('cpu', threads)] * cpu_lanes
+    return assignments
+
+def make_lane_backend(kind, assignment, edgetpu_model, cpu_model, num_classes=6):
+    '''Create the backend for a lane from its schedule_devices() assignment.'''
+    if kind == 'fake':
+        return make_backend('fake', num_classes=num_classes)
+    device_kind, value = assignment
+    if device_kind == 'edgetpu':
+        return make_backend(kind, edgetpu_model, cpu_model, device=value)
+    if kind == 'edgetpu':
+        raise ValueError('Not enough Edge TPUs for every lane')
+    return make_backend('cpu', cpu_model=cpu_model, num_threads=value)
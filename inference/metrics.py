@@ -0,0 +1,183 @@
+# Module to keep runtime metrics and serve them in Prometheus text format
+
+'''
+Counters and fixed-bucket histograms are allocated up front, so recording a
+value on the hot path is a dictionary-free bisect and an increment under a
+lock (around a microsecond). Values that already exist elsewhere (frames
+captured, dropped, ...) are read only when scraped, through collectors.
+
+    curl http://127.0.0.1:9108/metrics
+'''
+
+import bisect
+import http.server
+import threading
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SCORE_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0)
+SORT_BUCKETS = (0.5, 1, 2, 3, 4, 5, 6, 8, 10, 15)
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class Histogram:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # Last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+class Family:
+    '''A metric name with its labelled children, e.g. one histogram per stage.'''
+    def __init__(self, kind, name, help_text, label_names, factory):
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        # Look children up once at setup and keep them, not per frame
+        values = tuple(str(value) for value in values)
+        with self.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = self.factory()
+            return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in children:
+            if self.kind == 'counter':
+                lines.append(f'{self.name}{format_labels(self.label_names, values)} {child.value}')
+                continue
+            with child.lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(list(child.buckets) + ['+Inf'], counts):
+                cumulative += count
+                labels = format_labels(self.label_names, values, ('le', bound))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.label_names, values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.families = []
+        self.collectors = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help_text, label_names=()):
+        return self.add(Family('counter', name, help_text, label_names, Counter))
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.add(Family('histogram', name, help_text, label_names,
+                               lambda: Histogram(buckets)))
+
+    def add(self, family):
+        with self.lock:
+            self.families.append(family)
+        return family
+
+    def add_collector(self, key, collector):
+        '''
+        `collector()` returns (name, kind, help, labels dict, value) samples,
+        read at scrape time. Replaces any collector with the same key.
+        '''
+        with self.lock:
+            self.collectors[key] = collector
+
+    def remove_collector(self, key):
+        with self.lock:
+            self.collectors.pop(key, None)
+
+    def render(self):
+        with self.lock:
+            families = list(self.families)
+            collectors = list(self.collectors.values())
+        lines = []
+        for family in families:
+            lines += family.render()
+
+        # Collected samples, grouped by name so HELP/TYPE appear once
+        grouped = {}
+        for collector in collectors:
+            for name, kind, help_text, labels, value in collector():
+                grouped.setdefault(name, (kind, help_text, []))[2].append((labels, value))
+        for name, (kind, help_text, samples) in grouped.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            for labels, value in samples:
+                lines.append(f'{name}{format_labels(labels.keys(), labels.values())} {value}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# Metrics recorded on the hot path
+stage_latency = registry.histogram('classibin_stage_latency_seconds',
+                                   'Time spent in each pipeline stage per frame',
+                                   ['lane', 'stage'], LATENCY_BUCKETS)
+inference_score = registry.histogram('classibin_inference_score',
+                                     'Top-1 score of every inferred frame',
+                                     ['lane'], SCORE_BUCKETS)
+frame_latency = registry.histogram('classibin_frame_latency_seconds',
+                                   'Time from camera read to decision of every inferred frame',
+                                   ['lane'], LATENCY_BUCKETS)
+actuations = registry.counter('classibin_actuations_total', 'Sorts requested per bin',
+                              ['lane', 'bin'])
+sort_duration = registry.histogram('classibin_sort_duration_seconds',
+                                   'Duration of motion commands such as sortPos',
+                                   ['command'], SORT_BUCKETS)
+
+def observe_motion(report):
+    # MotionController report callback
+    if report.get('event') == 'done':
+        sort_duration.labels(report['command']).observe(report['duration'])
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep the status line clean
+
+def serve(port=9108, host='127.0.0.1'):
+    '''Serve /metrics on a background thread and return the server.'''
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -18,12 +18,20 @@ S_+VE - P_4; S_-VE - P_6; S_DAT - P_8
 
 '''
 
-import RPi.GPIO as GPIO
-import time
+import functools
+import json
+import os
+import hardware
+from hardware import SimGPIO
+
+GPIO, clock = hardware.load() # RPi.GPIO, or the simulator when CLASSIBIN_GPIO asks for it
 
 # Settings
 enable_servo = True
 enable_stepper = True
+enable_ramp = True # Trapezoidal acceleration, otherwise constant step_delay
+return_to_centre = False # Go straight from bin to bin instead of back to centre each time
+home_on_start = False # Drive back to centre from the saved position when the motion process starts
 
 # Define constants
 servo_pin = 14 # GPIO pin number
@@ -35,7 +43,20 @@ speed = 10
 min_delay = 0.0005
 max_delay = 0.0022
 step_delay = max_delay-((max_delay-min_delay)*speed/100)
+cruise_speed = 60 # Top speed of a ramped move, same scale as speed
+cruise_delay = max_delay-((max_delay-min_delay)*cruise_speed/100)
+acceleration = 3000 # steps/s^2
 nema_pins = [18, 27, 17, 22]
+bin_distances = {1: -16, 2: -6.5, 3: 6, 4: 17} # In cm from centre
+position_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '.carriage_position.sim' if isinstance(GPIO, SimGPIO) else '.carriage_position')
+
+half_seq = [
+    [1,0,0,0], [1,1,0,0], [0,1,0,0], [0,1,1,0],
+    [0,0,1,0], [0,0,1,1], [0,0,0,1], [1,0,0,1]
+]
+wave_seq = [[1,0,0,0], [0,1,0,0], [0,0,1,0], [0,0,0,1]]
+full_seq = [[1,1,0,0], [0,1,1,0], [0,0,1,1], [1,0,0,1]]
 
 # Initialise GPIO
 
@@ -49,72 +70,123 @@ for gpio in range(4):
     GPIO.setup(nema_pins[gpio], GPIO.OUT)
     GPIO.output(nema_pins[gpio], GPIO.LOW)
 
+# Carriage position, in half steps from centre, kept across restarts
+def loadPosition():
+    try:
+        with open(position_file) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    if state.get('moving_to') is not None:
+        print(f"Carriage stopped mid-move to {state['moving_to']}, assuming {state['position']}")
+    return state['position']
+
+def savePosition(moving_to=None):
+    # Write then rename, so a crash never leaves a half-written file
+    temp_file = position_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump({'position': carriage_position, 'moving_to': moving_to}, f)
+    os.replace(temp_file, position_file)
+
+carriage_position = loadPosition()
+
 def sortPos(position): # 1, 2, 3, 4
-    if (position >= 1 and position <= 4):
-        if position == 1:
-            distance = -16# In cm
-        if position == 2:
-            distance = -6.5
-        if position == 3:
-            distance = 6
-        if position == 4:
-            distance = 17
+    if position in bin_distances:
         if enable_stepper == True:
-            turnStepper(distance)
+            moveTo(stepCount(bin_distances[position], "HALF"))
         if enable_servo == True:
             turnServo(60)
-            time.sleep(1)
+            clock.sleep(1)
             turnServo(90)
-            time.sleep(0.5)
-        if enable_stepper == True:
-            turnStepper(distance*-1)
-        time.sleep(1)
+            clock.sleep(0.5)
+        if enable_stepper == True and return_to_centre == True:
+            moveTo(0)
+        clock.sleep(1)
     else:
         print("Invalid compartment input")
+
+def homeCarriage():
+    moveTo(0)
     
 # Helper function for servo
 def turnServo(angle):
     duty = 2.5*(1+(angle/45))
     servo.ChangeDutyCycle(duty)
-    time.sleep(0.5)
+    clock.sleep(0.5)
     servo.ChangeDutyCycle(0)
     
-def turnStepper(distance, mode="FULL"):
+def stepCount(distance, mode="FULL"):
     angle = distance*90
     if mode == "HALF":
-        step_count = round(angle/0.9)
-    else:
-        step_count = round(angle/1.8)
-    if step_count >= 0:
-        step_range = range(step_count)
-        i = step_range[0]
-    elif step_count <= 0:
-        step_range = range(abs(step_count), 0, -1)
-        i = step_range[-1]
-    half_seq = [
-        [1,0,0,0], [1,1,0,0], [0,1,0,0], [0,1,1,0],
-        [0,0,1,0], [0,0,1,1], [0,0,0,1], [1,0,0,1]
-    ]
-    wave_seq = [[1,0,0,0], [0,1,0,0], [0,0,1,0], [0,0,0,1]]
-    full_seq = [[1,1,0,0], [0,1,1,0], [0,0,1,1], [1,0,0,1]]
-        
+        return round(angle/0.9)
+    return round(angle/1.8)
+
+def stepSequence(step_count, mode="FULL", start=0):
+    # Pin states for every step, as written in one GPIO.output call, continuing from phase `start`
     if mode == "HALF":
-        for phrase in step_range:
-            for pin in range(4):
-                GPIO.output(nema_pins[pin], half_seq[phrase%8][pin])
-            time.sleep(step_delay)
+        seq = half_seq
     elif mode == "WAVE":
-        for phrase in step_range:
-            for pin in range(4):
-                GPIO.output(nema_pins[pin], wave_seq[phrase%4][pin])
-            time.sleep(step_delay)
-    elif mode == "FULL":
-        for phrase in step_range:
-            for pin in range(4):
-                GPIO.output(nema_pins[pin], full_seq[phrase%4][pin])
-            time.sleep(step_delay)
-                
+        seq = wave_seq
+    else:
+        seq = full_seq
+    direction = 1 if step_count >= 0 else -1
+    return [seq[(start+direction*(i+1))%len(seq)] for i in range(abs(step_count))]
+
+def stepTimings(steps, ramp=None):
+    '''
+    Offset of every step from the start of the move, in seconds, plus the
+    total duration, for the current ramp and speed settings. The speed
+    ramps up from step_delay to cruise_delay at `acceleration`, cruises,
+    then ramps down symmetrically (trapezoid, or a triangle for moves too
+    short to reach cruise speed).
+    '''
+    if ramp is None:
+        ramp = enable_ramp
+    return rampTimings(steps, ramp, step_delay, cruise_delay, acceleration)
+
+@functools.lru_cache(maxsize=32) # Only a handful of distinct moves, every setting is part of the key
+def rampTimings(steps, ramp, start_delay, cruise_delay, acceleration):
+    start_speed = 1/start_delay
+    cruise = max(1/cruise_delay, start_speed) if ramp else start_speed
+    offsets = []
+    elapsed = 0.0
+    for step in range(steps):
+        offsets.append(elapsed)
+        # v^2 = v0^2 + 2an, counted from whichever end of the move is nearer
+        from_end = min(step, steps-1-step)
+        speed_now = min((start_speed**2 + 2*acceleration*from_end)**0.5, cruise)
+        elapsed += 1/speed_now
+    return tuple(offsets), elapsed
+
+def runSteps(states, offsets, duration):
+    # Each step is due at an absolute time, so loop overhead and sleep jitter don't add up
+    start_time = clock.monotonic()
+    for state, offset in zip(states, offsets):
+        clock.sleep_until(start_time + offset)
+        GPIO.output(nema_pins, state)
+    clock.sleep_until(start_time + duration)
+
+def moveBy(step_count, mode="FULL"):
+    global carriage_position
+    half_steps = 1 if mode == "HALF" else 2
+    phase = carriage_position if mode == "HALF" else carriage_position//2
+    states = stepSequence(step_count, mode, phase)
+    offsets, duration = stepTimings(len(states))
+    target = carriage_position + step_count*half_steps
+    savePosition(moving_to=target)
+    runSteps(states, offsets, duration)
     
     # Cleanup
-    for gpio in range(4):
-        GPIO.output(nema_pins[gpio], GPIO.LOW)
+    GPIO.output(nema_pins, GPIO.LOW)
+    carriage_position = target
+    savePosition()
+
+def moveTo(target, mode="FULL"):
+    # Target in half steps from centre
+    half_steps = 1 if mode == "HALF" else 2
+    step_count = int((target-carriage_position)/half_steps)
+    if step_count != 0:
+        moveBy(step_count, mode)
+
+def turnStepper(distance, mode="FULL"):
+    moveBy(stepCount(distance, mode), mode)
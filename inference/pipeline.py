@@ -0,0 +1,223 @@
+# Module to run the classify loop as a pipeline of worker threads
+
+'''
+Each stage runs on its own thread and stages are joined by bounded queues,
+so throughput is limited by the slowest stage instead of the sum of all of
+them. cv2, NumPy and the TFLite interpreter release the GIL while working,
+so e.g. the next frame can be preprocessed while the TPU runs the current one.
+
+    source -> [queue] -> stage 1 -> [queue] -> stage 2 -> ...
+
+Queue policies:
+    block        Producer waits for space (no frames lost, back-pressure)
+    drop_oldest  Oldest queued item is discarded (always work on the newest)
+    drop_newest  Incoming item is discarded when full
+'''
+
+import collections
+import threading
+import time
+
+POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+class BoundedQueue:
+    def __init__(self, maxsize=1, policy='block'):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown queue policy: {policy}')
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                elif self.policy == 'drop_oldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    self.condition.wait_for(
+                        lambda: len(self.items) < self.maxsize or self.closed)
+            if self.closed:
+                return False
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def get(self):
+        '''Return the next item, or None once closed and drained.'''
+        with self.condition:
+            self.condition.wait_for(lambda: self.items or self.closed)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.items)
+
+class StageStats:
+    def __init__(self, keep_samples=False, histogram=None):
+        self.lock = threading.Lock()
+        self.histogram = histogram # e.g. a metrics.Histogram
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+        self.samples = [] if keep_samples else None
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.last = seconds
+            if seconds > self.max:
+                self.max = seconds
+            if self.samples is not None:
+                self.samples.append(seconds)
+        if self.histogram is not None:
+            self.histogram.observe(seconds)
+
+    def durations(self):
+        '''Recorded durations in seconds (needs keep_samples).'''
+        with self.lock:
+            return list(self.samples or [])
+
+    def summary(self, dropped=0):
+        '''Timing summary in milliseconds, with `dropped` items passed through.'''
+        with self.lock:
+            return {
+                'count': self.count,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+                'last_ms': self.last * 1000,
+                'max_ms': self.max * 1000,
+                'dropped': dropped,
+            }
+
+class Stage:
+    '''
+    A named step of the pipeline.
+
+    `function` takes the item from the previous stage and returns the item
+    for the next one. Returning None drops the item (e.g. nothing to do).
+    `maxsize` and `policy` configure the queue in front of this stage.
+    '''
+    def __init__(self, name, function, maxsize=1, policy='block'):
+        self.name = name
+        self.function = function
+        self.maxsize = maxsize
+        self.policy = policy
+
+class Pipeline:
+    def __init__(self, source, stages, source_name='capture', keep_samples=False,
+                 histograms=None):
+        '''
+        `source` is called repeatedly for new items until it returns None.
+        With `keep_samples` every stage duration is kept for percentiles.
+        `histograms` maps stage names to objects with an observe(seconds)
+        method that also get every duration.
+        '''
+        histograms = histograms or {}
+        self.source = Stage(source_name, source)
+        self.stages = list(stages)
+        self.queues = [BoundedQueue(stage.maxsize, stage.policy) for stage in self.stages]
+        self.stats = {stage.name: StageStats(keep_samples, histograms.get(stage.name))
+                      for stage in [self.source] + self.stages}
+        self.running = False
+        self.error = None
+        self.workers = []
+
+    def start(self):
+        self.running = True
+        self.workers = [threading.Thread(target=self.source_loop, daemon=True)]
+        for index in range(len(self.stages)):
+            self.workers.append(
+                threading.Thread(target=self.stage_loop, args=(index,), daemon=True))
+        for worker in self.workers:
+            worker.start()
+        return self
+
+    def source_loop(self):
+        stats = self.stats[self.source.name]
+        try:
+            while self.running:
+                start_time = time.perf_counter()
+                item = self.source.function()
+                stats.add(time.perf_counter() - start_time)
+                if item is None:
+                    break
+                self.forward(0, item)
+        except BaseException as error:
+            self.fail(error)
+        finally:
+            self.close_from(0)
+
+    def stage_loop(self, index):
+        stage = self.stages[index]
+        stats = self.stats[stage.name]
+        queue = self.queues[index]
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                start_time = time.perf_counter()
+                item = stage.function(item)
+                stats.add(time.perf_counter() - start_time)
+                if item is not None:
+                    self.forward(index + 1, item)
+        except BaseException as error:
+            self.fail(error)
+        finally:
+            self.close_from(index + 1)
+
+    def forward(self, index, item):
+        if index < len(self.queues):
+            self.queues[index].put(item)
+
+    def close_from(self, index):
+        if index < len(self.queues):
+            self.queues[index].close()
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stop()
+
+    def stop(self):
+        self.running = False
+        for queue in self.queues:
+            queue.close()
+
+    def join(self):
+        '''Wait for every stage to finish and re-raise the first stage error.'''
+        for worker in self.workers:
+            while worker.is_alive():
+                worker.join(0.1) # Stay responsive to KeyboardInterrupt
+        if self.error is not None:
+            raise self.error
+
+    def is_alive(self):
+        return any(worker.is_alive() for worker in self.workers)
+
+    def samples(self, name):
+        '''Recorded durations of a stage in seconds (needs keep_samples).'''
+        return self.stats[name].durations()
+
+    def timings(self):
+        '''Per-stage timing summary in milliseconds, plus queue drops.'''
+        queues = [None] + self.queues
+        return {stage.name: self.stats[stage.name].summary(queue.dropped if queue is not None else 0)
+                for stage, queue in zip([self.source] + self.stages, queues)}
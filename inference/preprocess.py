@@ -0,0 +1,54 @@
+# Module to prepare camera frames for the interpreter without per-frame allocations
+
+import cv2
+import numpy as np
+
+def crop_box(height, width):
+    # Same center square as crop_to_square in train/scripts/resize.py
+    min_dim = min(height, width)
+    top = (height - min_dim) // 2
+    left = (width - min_dim) // 2
+    return top, left, min_dim
+
+class Preprocessor:
+    '''
+    Center-crop, resize and BGR->RGB convert frames into preallocated buffers.
+
+    The crop is a view of the frame, the resize writes into a small scratch
+    buffer and the colour conversion writes into the destination, so no
+    full-frame copies are made. Without an explicit destination a small ring
+    of buffers is used, large enough that a buffer is not reused while an
+    earlier pipeline stage still holds it.
+
+    Area interpolation matches train/scripts/resize.py, so the model sees
+    camera frames downscaled the same way as its training images.
+    '''
+    def __init__(self, size, buffers=4, interpolation=cv2.INTER_AREA, crop=True):
+        self.size = tuple(size) # (width, height), as from input_size()
+        self.interpolation = interpolation
+        self.crop = crop
+        shape = (self.size[1], self.size[0], 3)
+        self.scratch = np.empty(shape, dtype=np.uint8)
+        self.ring = [np.empty(shape, dtype=np.uint8) for _ in range(max(1, buffers))]
+        self.ring_index = 0
+        self.frame_shape = None
+        self.box = None
+
+    def next_buffer(self):
+        buffer = self.ring[self.ring_index]
+        self.ring_index = (self.ring_index + 1) % len(self.ring)
+        return buffer
+
+    def __call__(self, frame, dst=None):
+        if dst is None:
+            dst = self.next_buffer()
+        if frame.shape[:2] != self.frame_shape:
+            self.frame_shape = frame.shape[:2]
+            self.box = crop_box(*self.frame_shape)
+        if self.crop:
+            top, left, min_dim = self.box
+            frame = frame[top:top+min_dim, left:left+min_dim]
+        # Resize first so the colour conversion only touches the small image
+        cv2.resize(frame, self.size, dst=self.scratch, interpolation=self.interpolation)
+        cv2.cvtColor(self.scratch, cv2.COLOR_BGR2RGB, dst=dst)
+        return dst
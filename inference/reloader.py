@@ -0,0 +1,131 @@
+# Module to swap in a retrained model while the lanes keep running
+
+'''
+The watcher polls the model and label files. Once they changed and have
+stopped changing for `settle` seconds (retrain.py writes them in several
+steps), new interpreters are built and warmed up on a background thread,
+validated on the frames the lanes just saw, and handed to `swap`. Lanes
+swap between two frames, so capture and the pipeline never stop.
+
+After a swap a lane keeps its previous model until the new one has run
+lanes.CONFIRM_FRAMES frames; if the new interpreter fails or returns non-finite
+scores before that, the lane rolls back to the previous model.
+'''
+
+import os
+import threading
+import time
+import numpy as np
+import classify
+
+def model_paths(settings):
+    return [*classify.model_files(settings), os.path.join(settings['model_dir'], settings['model_labels'])]
+
+def file_signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+def validate(backend, labels, frames, input_size, detect=False):
+    '''Raise ValueError when `backend` can't replace the running model.'''
+    if backend.input_size() != input_size:
+        raise ValueError(f'input size changed from {input_size} to {backend.input_size()}, '
+                         'restart to use this model')
+    if detect:
+        outputs = len(backend.interpreter.get_output_details())
+        if outputs not in (2, 4):
+            raise ValueError(f'{outputs} outputs, not an SSD detection model')
+    elif backend.num_classes() < len(labels):
+        raise ValueError(f'{backend.num_classes()} outputs for {len(labels)} labels')
+    for frame in frames:
+        backend.set_input(frame)
+        backend.invoke()
+        scores = backend.get_scores()
+        if not np.all(np.isfinite(scores)):
+            raise ValueError('non-finite scores')
+
+def swap_lanes(lanes, backends, labels, class_thresholds=None):
+    for lane, backend in zip(lanes, backends):
+        lane.swap_backend(backend, labels, class_thresholds)
+
+class ModelWatcher:
+    def __init__(self, settings, swap, frames=None, input_size=(224, 224), interval=2.0, settle=2.0):
+        '''
+        `swap(backends, labels, class_thresholds)` installs validated
+        backends (one per lane) with the thresholds file next to them,
+        `frames()` returns recent preprocessed frames to validate on.
+        '''
+        self.settings = settings
+        self.swap = swap
+        self.frames = frames
+        self.input_size = input_size
+        self.interval = interval
+        self.settle = settle
+        self.stopped = threading.Event()
+        self.thread = None
+        self.reloads = 0
+        self.failures = 0
+        self.mark_loaded()
+
+    def mark_loaded(self):
+        # Call when the current files were loaded some other way
+        self.loaded = file_signature(model_paths(self.settings))
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.watch_loop, name='model-watcher', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def watch_loop(self):
+        pending = None
+        changed_time = 0
+        while not self.stopped.wait(self.interval):
+            signature = file_signature(model_paths(self.settings))
+            # A missing file is still being written, or not deployed (e.g. the CPU model)
+            if signature == self.loaded or signature[0] is None or signature[-1] is None:
+                pending = None
+                continue
+            # Wait until the files stop changing
+            if signature != pending:
+                pending = signature
+                changed_time = time.monotonic()
+                continue
+            if time.monotonic() - changed_time < self.settle:
+                continue
+            self.loaded = signature
+            pending = None
+            self.reload()
+
+    def reload(self):
+        settings = dict(self.settings)
+        name = os.path.basename(classify.model_files(settings)[0])
+        start_time = time.perf_counter()
+        try:
+            labels = classify.load_labels(settings)
+            class_thresholds = classify.load_class_thresholds(settings)
+            backends = classify.make_backends(settings, labels)
+            frames = [frame for frame in (self.frames() if self.frames else []) if frame is not None]
+            if not frames:
+                width, height = self.input_size
+                frames = [np.zeros((height, width, 3), dtype=np.uint8)]
+            for backend in backends:
+                validate(backend, labels, frames, self.input_size, settings['mode'] == 'detect')
+        except Exception as error:
+            self.failures += 1
+            print(f"\nNot reloading {name}, keeping the running model: {error}")
+            return False
+        self.swap(backends, labels, class_thresholds)
+        self.reloads += 1
+        print(f"\nReloaded {name} in {time.perf_counter() - start_time:.2f} s")
+        return True
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Measure sortPos() cycle time and step timing on the simulated GPIO
+
+'''
+Runs motor.py against hardware.SimGPIO on a virtual clock, so a full sort
+cycle takes milliseconds of real time. `--overshoot` and `--output-cost`
+model sleep latency and GPIO write time on a loaded Pi, to see how much of
+it the deadline scheduler absorbs.
+
+    python3 simulate.py --bins 1 4 2 --overshoot 0.0001 --vcd sort.vcd
+'''
+
+import argparse
+import json
+import os
+os.environ['CLASSIBIN_GPIO'] = 'sim'
+import motor
+
+def step_errors(times, offsets, duration):
+    # Actual step times against the planned table, relative to the first step
+    if not times:
+        return []
+    planned = list(offsets)[1:] + [duration]
+    actual = [t - times[0] for t in times[1:]]
+    return [a - p for a, p in zip(actual, planned)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated sortPos() cycle times')
+    parser.add_argument('--bins', type=int, nargs='+', default=[1, 2, 3, 4], help='bins to sort to, in order')
+    parser.add_argument('--overshoot', type=float, default=0.0, help='extra seconds per sleep')
+    parser.add_argument('--output-cost', type=float, default=0.0, help='seconds per pin write')
+    parser.add_argument('--no-ramp', action='store_true', help='constant step_delay moves')
+    parser.add_argument('--vcd', help='export the waveform as a VCD file')
+    parser.add_argument('--csv', help='export the waveform as CSV')
+    args = parser.parse_args()
+
+    motor.clock.sleep_overshoot = args.overshoot
+    motor.GPIO.output_cost = args.output_cost
+    motor.enable_ramp = not args.no_ramp
+    motor.carriage_position = 0
+    motor.GPIO.reset()
+
+    report = {'cycles': []}
+    for position in args.bins:
+        start_time = motor.clock.monotonic()
+        first_event = len(motor.GPIO.events)
+        motor.sortPos(position)
+        cycle = {'bin': position, 'cycle_s': motor.clock.monotonic() - start_time}
+
+        # Step timing of the stepper move of this cycle
+        times = motor.GPIO.transitions(motor.nema_pins, first_event)[:-1] # Last is the de-energise
+        steps = len(times)
+        if steps:
+            offsets, duration = motor.stepTimings(steps, motor.enable_ramp)
+            errors = step_errors(times, offsets, duration)
+            cycle['steps'] = steps
+            cycle['move_s'] = times[-1] - times[0]
+            cycle['planned_move_s'] = offsets[-1]
+            if errors:
+                cycle['max_step_error_us'] = max(abs(e) for e in errors) * 1e6
+        report['cycles'].append(cycle)
+    report['total_s'] = sum(cycle['cycle_s'] for cycle in report['cycles'])
+
+    if args.vcd:
+        motor.GPIO.export_vcd(args.vcd)
+    if args.csv:
+        motor.GPIO.export_csv(args.csv)
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
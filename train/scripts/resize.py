@@ -1,70 +1,269 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
 import os
+import struct
 import cv2
+import numpy as np
 
 DIM1 = 224
 DIM2 = 224
 
+# Recorded per output, a change re-resizes everything
+OUTPUT_PARAMS = {'dim1': DIM1, 'dim2': DIM2, 'crop': 'center-square', 'resize': 'cv2-area',
+                 'decode': 'jpeg-reduced'}
+MANIFEST_FILE = '.manifest.json'
+CATEGORIES = ('glass', 'paper', 'cardboard', 'plastic', 'metal', 'trash')
+
+# Packed output, see packShards()
+SHARD_SIZE = 1024 # Images per shard, about 150 MB at 224x224
+INDEX_FILE = 'index.json'
+
+# JPEG DCT scale factors OpenCV can decode at directly
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2))
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
 def crop_to_square(image):
     height, width = image.shape[:2]
-    
+
     # Determine the center crop area
     min_dim = min(height, width)
     top = (height - min_dim) // 2
     left = (width - min_dim) // 2
-    
+
     # Crop the center square from the image
     return image[top:top+min_dim, left:left+min_dim]
 
 def resize(image, dim1, dim2):
     # First crop the image to a square
     cropped_image = crop_to_square(image)
-    # Then resize to the desired dimensions
-    return cv2.resize(cropped_image, (dim1, dim2))
+    # Then resize to the desired dimensions, area averaging for the downscale
+    return cv2.resize(cropped_image, (dim1, dim2), interpolation=cv2.INTER_AREA)
 
-def fileWalk(directory, destPath):
+def jpegSize(data):
+    '''(width, height) from the JPEG frame header, None if not found.'''
+    if data[:2] != b'\xff\xd8':
+        return None
+    index = 2
+    while index + 4 <= len(data):
+        if data[index] != 0xFF:
+            return None
+        marker = data[index + 1]
+        if marker == 0xFF: # Fill byte
+            index += 1
+            continue
+        length = struct.unpack('>H', data[index + 2:index + 4])[0]
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack('>HH', data[index + 5:index + 9])
+            return width, height
+        index += 2 + length
+    return None
+
+def decode(data, dim1, dim2):
+    '''
+    Decode at the smallest JPEG scale (1/8, 1/4, 1/2) whose center square
+    is still at least dim1 x dim2, so big photos never decode at full size.
+    '''
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    size = jpegSize(data)
+    if size is not None:
+        min_dim = min(size)
+        for factor, flag in REDUCED_FLAGS:
+            if min_dim // factor >= max(dim1, dim2):
+                return cv2.imdecode(buffer, flag)
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+def loadManifest(destPath):
+    '''
+    Manifest of a destination folder: for every output file name, the
+    source path, size, mtime and SHA-1 it was made from and OUTPUT_PARAMS.
+    '''
+    try:
+        with open(os.path.join(destPath, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def saveManifest(destPath, manifest):
+    # Write then rename, so an interrupted run never leaves a truncated manifest
+    path = os.path.join(destPath, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def fileHash(data):
+    return hashlib.sha1(data).hexdigest()
+
+def isUpToDate(entry, source, stat, destFilePath):
+    # Cheap checks only, nothing is read or decoded
+    return (entry is not None and entry['params'] == OUTPUT_PARAMS
+            and entry['src'] == source and entry['size'] == stat.st_size
+            and entry['mtime_ns'] == stat.st_mtime_ns and os.path.exists(destFilePath))
+
+def resizeFile(task):
+    '''Worker: resize one file, return its manifest entry (None if unreadable).'''
+    srcFilePath, source, destFilePath, stat, entry = task
+    with open(srcFilePath, 'rb') as f:
+        data = f.read()
+    digest = fileHash(data)
+    manifest_entry = {'src': source, 'size': stat[0], 'mtime_ns': stat[1],
+                      'sha1': digest, 'params': OUTPUT_PARAMS}
+
+    # Touched but unchanged (e.g. copied again): only the manifest needs updating
+    if (entry is not None and entry['sha1'] == digest and entry['params'] == OUTPUT_PARAMS
+            and os.path.exists(destFilePath)):
+        return manifest_entry, False
+
+    pic = decode(data, DIM1, DIM2)
+    if pic is None:
+        return None, False  # Skip files that couldn't be opened as images
+
+    # Resize (cropping to square and then resizing)
+    picResized = resize(pic, DIM1, DIM2)
+
+    # Save the resized image
+    cv2.imwrite(destFilePath, picResized)
+    return manifest_entry, True
+
+def initWorker():
+    # One process per core already, keep OpenCV from starting its own threads
+    cv2.setNumThreads(1)
+
+def fileWalk(directory, destPath, executor, force=False):
     try:
         os.makedirs(destPath)
     except OSError:
         if not os.path.isdir(destPath):
             raise
 
+    manifest = {} if force else loadManifest(destPath)
+    new_manifest = {}
+    tasks = []
+    skipped = 0
     for subdir, dirs, files in os.walk(directory):
         for file in files:
             if len(file) <= 4 or file[-4:] != '.jpg':
                 continue
 
             srcFilePath = os.path.join(subdir, file)
+            source = os.path.relpath(srcFilePath, directory) # Survives moving the tree
             destFilePath = os.path.join(destPath, file)
+            stat = os.stat(srcFilePath)
+            entry = manifest.get(file)
+
+            # Skip files whose source and settings did not change since the last run
+            if isUpToDate(entry, source, stat, destFilePath):
+                new_manifest[file] = entry
+                skipped += 1
+                continue
+            tasks.append((srcFilePath, source, destFilePath, (stat.st_size, stat.st_mtime_ns), entry))
+
+    resized = 0
+    try:
+        results = executor.map(resizeFile, tasks, chunksize=16)
+        for (_, _, destFilePath, _, _), (entry, written) in zip(tasks, results):
+            if entry is None:
+                continue
+            new_manifest[os.path.basename(destFilePath)] = entry
+            if written:
+                resized += 1
+            else:
+                skipped += 1
+    finally:
+        # Keep what was done even when interrupted, sources that went away are dropped
+        saveManifest(destPath, new_manifest)
+    print(f"{os.path.basename(destPath)}: resized {resized}, skipped {skipped} unchanged files.")
+
+def packWorker(srcFilePath):
+    '''Worker: decode and resize one file to RGB pixels (None if unreadable).'''
+    with open(srcFilePath, 'rb') as f:
+        pic = decode(f.read(), DIM1, DIM2)
+    if pic is None:
+        return None
+    # RGB, like the images image_dataset_from_directory hands to retrain.py
+    return cv2.cvtColor(resize(pic, DIM1, DIM2), cv2.COLOR_BGR2RGB)
+
+def listFiles(directory):
+    return sorted(os.path.join(subdir, file)
+                  for subdir, dirs, files in os.walk(directory)
+                  for file in files if len(file) > 4 and file[-4:] == '.jpg')
 
-            # Check if file already exists and is the correct size
-            if os.path.exists(destFilePath):
-                existing_image = cv2.imread(destFilePath)
-                if existing_image is not None:
-                    existing_height, existing_width = existing_image.shape[:2]
-                    if existing_height == DIM1 and existing_width == DIM2:
-                        print(f"Skipping {file}, already resized.")
-                        continue
+def packShards(prepath, packPath, executor, shard_size=SHARD_SIZE):
+    '''
+    Write the resized pixels of every image into uint8 (N, DIM2, DIM1, 3)
+    .npy shards, with int16 labels alongside and an index.json listing the
+    shards, their image counts and the class names. Labels follow the
+    sorted folder names, as image_dataset_from_directory numbers them, and
+    pixels go straight from the originals into the shards without a second
+    JPEG encode. retrain.py memory-maps the shards.
+    '''
+    os.makedirs(packPath, exist_ok=True)
+    # Drop the old index before any shard is rewritten, so an interrupted
+    # re-pack leaves no index and retrain.py falls back to the JPEGs
+    index_path = os.path.join(packPath, INDEX_FILE)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    classes = sorted(CATEGORIES)
+    files = [(path, label) for label, category in enumerate(classes)
+             for path in listFiles(os.path.join(prepath, category))]
 
-            pic = cv2.imread(srcFilePath)
-            if pic is None:
-                continue  # Skip files that couldn't be opened as images
+    shards = []
+    images = labels = None
+    count = 0
+    def finishShard():
+        images.flush()
+        np.save(os.path.join(packPath, f'labels-{len(shards):05d}.npy'), labels[:count])
+        shards.append({'images': f'shard-{len(shards):05d}.npy',
+                       'labels': f'labels-{len(shards):05d}.npy', 'count': count})
 
-            # Resize (cropping to square and then resizing)
-            picResized = resize(pic, DIM1, DIM2)
+    results = executor.map(packWorker, [path for path, _ in files], chunksize=16)
+    for index, ((path, label), pixels) in enumerate(zip(files, results)):
+        if pixels is None:
+            continue  # Skip files that couldn't be opened as images
+        if images is None:
+            capacity = min(shard_size, len(files) - index)
+            images = np.lib.format.open_memmap(os.path.join(packPath, f'shard-{len(shards):05d}.npy'),
+                                               mode='w+', dtype=np.uint8,
+                                               shape=(capacity, DIM2, DIM1, 3))
+            labels = np.zeros(capacity, dtype=np.int16)
+            count = 0
+        images[count] = pixels
+        labels[count] = label
+        count += 1
+        if count == len(images):
+            finishShard()
+            images = None
+    if images is not None:
+        finishShard() # Unreadable files leave unused rows at the end, `count` tells
 
-            # Save the resized image
-            cv2.imwrite(destFilePath, picResized)
-            print(f"Resized and saved {file}.")
+    # Index last, so a half-written pack is never picked up
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'classes': classes, 'dim1': DIM1, 'dim2': DIM2, 'params': OUTPUT_PARAMS,
+                   'shards': shards}, f, indent=1)
+    os.replace(index_path + '.tmp', index_path)
+
+    # Shards left over from an earlier, larger pack
+    for file in os.listdir(packPath):
+        if file.endswith('.npy') and file[-9:-4].isdigit() and int(file[-9:-4]) >= len(shards):
+            os.remove(os.path.join(packPath, file))
+    print(f"Packed {sum(shard['count'] for shard in shards)} images into {len(shards)} shards.")
 
 def main():
+    parser = argparse.ArgumentParser(description='Crop and resize images-original into images-resized')
+    parser.add_argument('--workers', type=int, default=None, help='processes (default: one per core)')
+    parser.add_argument('--force', action='store_true', help='ignore the manifest and redo every file')
+    parser.add_argument('--pack', action='store_true',
+                        help='write .npy shards to images-packed instead of JPEGs (for retrain.py)')
+    args = parser.parse_args()
+
     os.chdir(os.path.dirname(os.path.abspath(__file__))) # CD to script dir
     prepath = os.path.join(os.getcwd(), '../images-original')
-    glassDir = os.path.join(prepath, 'glass')
-    paperDir = os.path.join(prepath, 'paper')
-    cardboardDir = os.path.join(prepath, 'cardboard')
-    plasticDir = os.path.join(prepath, 'plastic')
-    metalDir = os.path.join(prepath, 'metal')
-    trashDir = os.path.join(prepath, 'trash')
+    if args.pack:
+        with concurrent.futures.ProcessPoolExecutor(args.workers, initializer=initWorker) as executor:
+            packShards(prepath, os.path.join(os.getcwd(), '../images-packed'), executor)
+        return
 
     destPath = os.path.join(os.getcwd(), '../images-resized')
     try:
@@ -73,24 +272,11 @@ def main():
         if not os.path.isdir(destPath):
             raise
 
-    # GLASS
-    fileWalk(glassDir, os.path.join(destPath, 'glass'))
-
-    # PAPER
-    fileWalk(paperDir, os.path.join(destPath, 'paper'))
-
-    # CARDBOARD
-    fileWalk(cardboardDir, os.path.join(destPath, 'cardboard'))
-
-    # PLASTIC
-    fileWalk(plasticDir, os.path.join(destPath, 'plastic'))
-
-    # METAL
-    fileWalk(metalDir, os.path.join(destPath, 'metal'))
-
-    # TRASH
-    fileWalk(trashDir, os.path.join(destPath, 'trash'))
+    # GLASS, PAPER, CARDBOARD, PLASTIC, METAL, TRASH
+    with concurrent.futures.ProcessPoolExecutor(args.workers, initializer=initWorker) as executor:
+        for category in CATEGORIES:
+            fileWalk(os.path.join(prepath, category), os.path.join(destPath, category),
+                     executor, args.force)
 
 if __name__ == '__main__':
     main()
-
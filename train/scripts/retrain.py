@@ -1,5 +1,10 @@
+import argparse
+import hashlib
+import json
 import os
+import time
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers, models
 from tensorflow.keras.applications import MobileNetV2
@@ -7,6 +12,11 @@ from tensorflow.keras.optimizers import Adam
 
 # Set paths
 DATASET_DIR = "../images-resized"
+DATASET_SHARDS = "../images-packed"  # From `resize.py --pack`, used instead of DATASET_DIR when present
+CHECKPOINT_DIR = "../checkpoints"  # Per-epoch checkpoints and state.json for --resume
+STATE_FILE = os.path.join(CHECKPOINT_DIR, "state.json")
+MODEL_WEIGHTS_FILE = os.path.join(CHECKPOINT_DIR, "model.weights.h5")  # After the last finished phase
+CACHE_DIR = "../cache"  # Bottleneck features, and decoded images with `--cache disk`
 MODEL_DIR = "../"
 TFLITE_MODEL_FILE = os.path.join(MODEL_DIR, "mobilenet_v2_recycle.tflite")
 EDGETPU_COMPILATION_OUTPUT = os.path.join(MODEL_DIR, "mobilenet_v2_recycle_edgetpu.tflite")
@@ -16,26 +26,191 @@ IMG_HEIGHT = 224
 IMG_WIDTH = 224
 BATCH_SIZE = 32
 EPOCHS = 20
+SHUFFLE_BUFFER = 1024  # Decoded images, reshuffled every epoch
+SHUFFLE_SEED = 1337  # Same batch order on every run
+VALIDATION_SPLIT = 0.2  # Of every class
+PATIENCE = 3  # Epochs without a lower val_loss before a phase stops
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif")
 
-def load_dataset_from_directory(dataset_dir, batch_size, img_height, img_width):
-    """Load dataset from directory and preprocess images."""
-    dataset = tf.keras.preprocessing.image_dataset_from_directory(
-        dataset_dir,
-        labels="inferred",
-        label_mode="int",  # Labels will be integers (class indices)
-        image_size=(img_height, img_width),
-        batch_size=batch_size,
-        shuffle=True
-    )
-    
-    # Normalize the dataset
-    normalization_layer = layers.Rescaling(1./255)
-    dataset = dataset.map(lambda x, y: (normalization_layer(x), y))
-    
-    return dataset
+def list_image_files(dataset_dir):
+    """Image paths and integer labels, classes numbered by sorted folder name."""
+    class_names = sorted(entry for entry in os.listdir(dataset_dir)
+                         if os.path.isdir(os.path.join(dataset_dir, entry)))
+    paths, labels = [], []
+    for label, class_name in enumerate(class_names):
+        for subdir, dirs, files in sorted(os.walk(os.path.join(dataset_dir, class_name))):
+            for file in sorted(files):
+                if file.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(subdir, file))
+                    labels.append(label)
+    return paths, labels, class_names
+
+def file_signature(paths, *params):
+    """Hash of the file list with sizes and mtimes, so changed images never hit a stale cache."""
+    signature = hashlib.sha1(repr(params).encode())
+    for path in paths:
+        stat = os.stat(path)
+        signature.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return signature.hexdigest()[:16]
+
+def cache_path(cache_dir, paths, img_height, img_width):
+    """Cache file prefix named after the file list."""
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, f"input-{file_signature(paths, img_height, img_width)}")
+
+def stratified_split(labels, validation_split, seed=SHUFFLE_SEED):
+    """Train and validation indices, with the same fraction of every class held out."""
+    labels = np.asarray(labels)
+    rng = np.random.default_rng(seed)
+    val_ids = [rng.permutation(np.flatnonzero(labels == label))[:int(round(np.sum(labels == label) * validation_split))]
+               for label in np.unique(labels)]
+    val_ids = np.sort(np.concatenate(val_ids)).astype(np.int64)
+    return np.setdiff1d(np.arange(len(labels)), val_ids), val_ids
+
+def load_dataset_from_directory(dataset_dir, batch_size, img_height, img_width, cache="memory",
+                                validation_split=VALIDATION_SPLIT):
+    """
+    Load dataset from directory and preprocess images, split into training
+    and validation sets. JPEGs are decoded in parallel once, then served
+    from the cache ("memory", "disk" or "none"), training images in a
+    seeded shuffle order.
+    """
+    paths, labels, class_names = list_image_files(dataset_dir)
+    train_ids, val_ids = stratified_split(labels, validation_split)
+    print(f"Found {len(paths)} files belonging to {len(class_names)} classes, "
+          f"using {len(val_ids)} for validation.")
+
+    def decode(path, label):
+        image = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+        image = tf.image.resize(image, (img_height, img_width))
+        return tf.saturate_cast(tf.round(image), tf.uint8), label  # uint8 keeps the cache 4x smaller
+
+    def make_dataset(ids, shuffle):
+        if shuffle:
+            # Files are listed class by class and the buffer below holds only
+            # part of the training set, so mix the whole list first
+            ids = np.random.default_rng(SHUFFLE_SEED).permutation(ids)
+        subset_paths = [paths[i] for i in ids]
+        subset_labels = tf.constant([labels[i] for i in ids], dtype=tf.int32)
+        dataset = tf.data.Dataset.from_tensor_slices((subset_paths, subset_labels))
+        dataset = dataset.map(decode, num_parallel_calls=tf.data.AUTOTUNE)
+        if cache == "memory":
+            dataset = dataset.cache()
+        elif cache == "disk":
+            dataset = dataset.cache(cache_path(CACHE_DIR, subset_paths, img_height, img_width))
+        if shuffle:
+            dataset = dataset.shuffle(SHUFFLE_BUFFER, seed=SHUFFLE_SEED, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size)
+
+        # Normalize the dataset
+        normalization_layer = layers.Rescaling(1./255)
+        dataset = dataset.map(lambda x, y: (normalization_layer(tf.cast(x, tf.float32)), y),
+                              num_parallel_calls=tf.data.AUTOTUNE)
+
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    return make_dataset(train_ids, True), make_dataset(val_ids, False), class_names
+
+def load_dataset_from_shards(shard_dir, batch_size, img_height, img_width, validation_split=VALIDATION_SPLIT):
+    """
+    Load the uint8 shards written by `resize.py --pack`, memory-mapped
+    instead of decoded, split as load_dataset_from_directory does.
+    """
+    with open(os.path.join(shard_dir, 'index.json')) as f:
+        index = json.load(f)
+    if (index['dim2'], index['dim1']) != (img_height, img_width):
+        raise ValueError(f"Shards are {index['dim1']}x{index['dim2']}, expected {img_width}x{img_height}")
+
+    # Only the index and labels are read here, pixels are paged in as batches need them
+    shards = [np.load(os.path.join(shard_dir, shard['images']), mmap_mode='r')[:shard['count']]
+              for shard in index['shards']]
+    labels = np.concatenate([np.load(os.path.join(shard_dir, shard['labels']))
+                             for shard in index['shards']]).astype(np.int32)
+    offsets = np.cumsum([0] + [len(shard) for shard in shards])
+    train_ids, val_ids = stratified_split(labels, validation_split)
+    print(f"Found {len(labels)} files belonging to {len(index['classes'])} classes in {len(shards)} shards, "
+          f"using {len(val_ids)} for validation.")
+
+    def gather(indices):
+        # Sorted, so every shard is read front to back
+        indices = np.sort(indices)
+        images = np.empty((len(indices), img_height, img_width, 3), dtype=np.uint8)
+        shard_ids = np.searchsorted(offsets, indices, side='right') - 1
+        for shard_id in np.unique(shard_ids):
+            rows = shard_ids == shard_id
+            images[rows] = shards[shard_id][indices[rows] - offsets[shard_id]]
+        return images, labels[indices]
+
+    def load_batch(indices):
+        images, batch_labels = tf.numpy_function(gather, [indices], [tf.uint8, tf.int32])
+        images.set_shape([None, img_height, img_width, 3])
+        batch_labels.set_shape([None])
+        return tf.cast(images, tf.float32), batch_labels
+
+    def make_dataset(ids, shuffle):
+        dataset = tf.data.Dataset.from_tensor_slices(ids)
+        if shuffle:
+            dataset = dataset.shuffle(len(ids), seed=SHUFFLE_SEED, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(load_batch, num_parallel_calls=tf.data.AUTOTUNE)
+
+        # Normalize the dataset, as load_dataset_from_directory does
+        normalization_layer = layers.Rescaling(1./255)
+        dataset = dataset.map(lambda x, y: (normalization_layer(x), y), num_parallel_calls=tf.data.AUTOTUNE)
+
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    return make_dataset(train_ids, True), make_dataset(val_ids, False), index['classes']
+
+class InputTimer(tf.keras.callbacks.Callback):
+    """
+    Splits every epoch into time spent waiting on the input pipeline and
+    time spent computing. Keras pulls the batch inside the train step, so
+    wrap() marks the moment it is handed over: batch begin to hand-over is
+    input wait, hand-over to batch end is compute.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pulled_time = None
+        self.begin_time = 0.0
+
+    def wrap(self, dataset):
+        def mark(images, labels):
+            pulled = tf.py_function(self.pulled, [], tf.float64)
+            with tf.control_dependencies([pulled]):
+                return tf.identity(images), tf.identity(labels)
+        # Not parallel, so it runs when the train step takes the batch
+        return dataset.map(mark)
+
+    def pulled(self):
+        self.pulled_time = time.perf_counter()
+        return 0.0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.input_time = 0.0
+        self.compute_time = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.begin_time = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end_time = time.perf_counter()
+        if self.pulled_time is None or self.pulled_time < self.begin_time:
+            self.compute_time += end_time - self.begin_time
+            return
+        self.input_time += self.pulled_time - self.begin_time
+        self.compute_time += end_time - self.pulled_time
+
+    def on_epoch_end(self, epoch, logs=None):
+        total = max(self.input_time + self.compute_time, 1e-9)
+        bound = "input-bound" if self.input_time > self.compute_time else "compute-bound"
+        print(f"Epoch {epoch + 1}: input {self.input_time:.1f} s ({self.input_time / total:.0%}), "
+              f"compute {self.compute_time:.1f} s, {bound}")
 
 def build_model(num_classes):
     print("\n===== [1/4] Building model =====")
+    # Head training runs on cached features, see train_head()
     # Load the MobileNetV2 model pre-trained on ImageNet
     base_model = MobileNetV2(input_shape=(IMG_HEIGHT, IMG_WIDTH, 3),
                              include_top=False,
@@ -60,6 +235,140 @@ def build_model(num_classes):
     
     return model
 
+def compute_bottlenecks(model, dataset, cache_file):
+    """
+    Pooled output of the frozen base for every image, with its label. Only
+    computed when the dataset changed, else loaded from `cache_file`.
+    """
+    features_file = cache_file + "-features.npy"
+    labels_file = cache_file + "-labels.npy"
+    if os.path.exists(features_file) and os.path.exists(labels_file):
+        print(f"Loading bottleneck features from {features_file}")
+        return np.load(features_file), np.load(labels_file)
+
+    base_model, pooling = model.layers[:2]
+    features, labels = [], []
+    for images, batch_labels in dataset:
+        features.append(pooling(base_model(images, training=False)).numpy())
+        labels.append(batch_labels.numpy())
+    features = np.concatenate(features)
+    labels = np.concatenate(labels)
+
+    # Write then rename, features last, so an interrupted run is recomputed
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    for path, array in ((labels_file, labels), (features_file, features)):
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, array)
+        os.replace(path + ".tmp", path)
+    print(f"Saved bottleneck features of {len(labels)} images to {features_file}")
+    return features, labels
+
+def save_atomic(save, path):
+    # Keras picks the format by extension, so the temporary name only gets a prefix
+    temp_path = os.path.join(os.path.dirname(path), "tmp-" + os.path.basename(path))
+    save(temp_path)
+    os.replace(temp_path, path)
+
+def checkpoint_file(phase):
+    return os.path.join(CHECKPOINT_DIR, f"{phase}.keras")
+
+def best_weights_file(phase):
+    return os.path.join(CHECKPOINT_DIR, f"{phase}-best.weights.h5")
+
+def load_state(resume, signature):
+    """The phase and epoch a run got to, or a fresh start when not resuming."""
+    if resume:
+        try:
+            with open(STATE_FILE) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            print(f"Nothing to resume in {CHECKPOINT_DIR}, starting over.")
+        else:
+            if state['dataset'] == signature:
+                print(f"Resuming at phase '{state['phase']}'.")
+                return state
+            print("The dataset changed since the checkpoints were written, starting over.")
+    return {'dataset': signature, 'phase': 'head', 'progress': {}}
+
+def save_state(state):
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    with open(STATE_FILE + ".tmp", "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(STATE_FILE + ".tmp", STATE_FILE)
+
+class Checkpoint(tf.keras.callbacks.Callback):
+    """
+    Saves the model with its optimizer state after every epoch, and its
+    weights whenever val_loss improved, then records the epoch and the
+    early stopping counters in the state file. Files are written before the
+    state, so the state never points at an epoch that wasn't saved.
+    """
+
+    def __init__(self, phase, state, early_stopping):
+        super().__init__()
+        self.phase = phase
+        self.state = state
+        self.early_stopping = early_stopping
+
+    def on_train_begin(self, logs=None):
+        # Runs after EarlyStopping reset its counters
+        progress = self.state['progress'].get(self.phase)
+        if progress is not None:
+            self.early_stopping.best = progress['best']
+            self.early_stopping.wait = progress['wait']
+
+    def on_epoch_end(self, epoch, logs=None):
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        if self.early_stopping.wait == 0:  # val_loss improved
+            save_atomic(self.model.save_weights, best_weights_file(self.phase))
+        save_atomic(self.model.save, checkpoint_file(self.phase))
+        self.state['progress'][self.phase] = {'epoch': epoch + 1, 'best': float(self.early_stopping.best),
+                                              'wait': self.early_stopping.wait}
+        save_state(self.state)
+
+def fit_phase(model, phase, state, x, validation_data, callbacks=(), **fit_args):
+    """
+    Fit for up to EPOCHS with early stopping on val_loss and a checkpoint
+    every epoch, continuing from the checkpoint if the phase was cut short.
+    Returns the model with the weights of its best epoch.
+    """
+    progress = state['progress'].get(phase)
+    initial_epoch = 0
+    if progress is not None:
+        model = tf.keras.models.load_model(checkpoint_file(phase))
+        initial_epoch = progress['epoch']
+        print(f"Continuing '{phase}' after epoch {initial_epoch}.")
+
+    early_stopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=PATIENCE)
+    if progress is None or progress['wait'] < PATIENCE:  # Else it had already stopped early
+        model.fit(x, validation_data=validation_data, epochs=EPOCHS, initial_epoch=initial_epoch,
+                  callbacks=[*callbacks, early_stopping, Checkpoint(phase, state, early_stopping)], **fit_args)
+    model.load_weights(best_weights_file(phase))
+    return model
+
+def finish_phase(model, state, next_phase):
+    save_atomic(model.save_weights, MODEL_WEIGHTS_FILE)
+    state['phase'] = next_phase
+    save_state(state)
+
+def train_head(model, state, features, labels, val_features, val_labels):
+    """
+    Train the Dense/Dropout/softmax head alone on bottleneck features, then
+    load its weights into the full model. The base is frozen (BatchNorm in
+    inference mode), so this gives the same head as fitting the full model.
+    """
+    head = models.Sequential([layers.Input(shape=features.shape[1:])] +
+                             [layer.__class__.from_config(layer.get_config()) for layer in model.layers[2:]])
+    head.compile(optimizer=Adam(),
+                 loss='sparse_categorical_crossentropy',
+                 metrics=['accuracy'])
+    head = fit_phase(head, 'head', state, features, (val_features, val_labels), y=labels,
+                     batch_size=BATCH_SIZE, shuffle=True)
+
+    for target, source in zip(model.layers[2:], head.layers):
+        target.set_weights(source.get_weights())
+    return model
+
 def fine_tune_model(model, num_fine_tune_layers=100):
     print("\n===== [2/4] Fine-tuning model =====")
     # Unfreeze the base model for fine-tuning
@@ -108,21 +417,49 @@ def compile_for_edgetpu(tflite_model_file, edgetpu_output_file):
     print(f'EdgeTPU model saved at: {edgetpu_output_file}')
 
 def main():
+    parser = argparse.ArgumentParser(description='Retrain MobileNet V2 on images-resized and compile it for the Edge TPU')
+    parser.add_argument('--cache', choices=('memory', 'disk', 'none'), default='memory',
+                        help=f'keep decoded images in memory, on disk in {CACHE_DIR}, or decode every epoch')
+    parser.add_argument('--resume', action='store_true',
+                        help=f'continue from the last completed epoch and phase in {CHECKPOINT_DIR}')
+    args = parser.parse_args()
+
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
-    
-    # Load the dataset from the directory
-    train_dataset = load_dataset_from_directory(DATASET_DIR, BATCH_SIZE, IMG_HEIGHT, IMG_WIDTH)
+    tf.random.set_seed(SHUFFLE_SEED)
+
+    # Load the dataset from the packed shards, or else from the directory
+    if os.path.exists(os.path.join(DATASET_SHARDS, 'index.json')):
+        train_dataset, val_dataset, class_names = load_dataset_from_shards(
+            DATASET_SHARDS, BATCH_SIZE, IMG_HEIGHT, IMG_WIDTH)
+        source_files = [os.path.join(DATASET_SHARDS, file) for file in sorted(os.listdir(DATASET_SHARDS))]
+    else:
+        train_dataset, val_dataset, class_names = load_dataset_from_directory(
+            DATASET_DIR, BATCH_SIZE, IMG_HEIGHT, IMG_WIDTH, args.cache)
+        source_files = list_image_files(DATASET_DIR)[0]
+    input_timer = InputTimer()
+    timed_dataset = input_timer.wrap(train_dataset)
+    signature = file_signature(source_files, IMG_HEIGHT, IMG_WIDTH, VALIDATION_SPLIT, SHUFFLE_SEED)
+    state = load_state(args.resume, signature)
 
-    # Get the number of classes from the dataset (it infers from folder structure)
-    num_classes = train_dataset.cardinality().numpy()  # Automatically inferred from folder structure
+    # One output per class folder
+    num_classes = len(class_names)
 
-    # Build and train the model
+    # Build the model and train the head on the frozen base's features
     model = build_model(num_classes)
-    model.fit(train_dataset, epochs=EPOCHS)
+    if state['phase'] == 'head':
+        bottleneck_file = os.path.join(CACHE_DIR, f"bottleneck-{signature}")
+        features, labels = compute_bottlenecks(model, train_dataset, bottleneck_file + "-train")
+        val_features, val_labels = compute_bottlenecks(model, val_dataset, bottleneck_file + "-val")
+        model = train_head(model, state, features, labels, val_features, val_labels)
+        finish_phase(model, state, 'fine_tune')
+    else:
+        model.load_weights(MODEL_WEIGHTS_FILE)
 
     # Fine-tune the model (optional)
-    model = fine_tune_model(model)
-    model.fit(train_dataset, epochs=EPOCHS)
+    if state['phase'] == 'fine_tune':
+        model = fine_tune_model(model)
+        model = fit_phase(model, 'fine_tune', state, timed_dataset, val_dataset, callbacks=[input_timer])
+        finish_phase(model, state, 'convert')
 
     # Convert to TFLite
     convert_to_tflite(model, train_dataset, TFLITE_MODEL_FILE)
@@ -132,4 +469,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-